@@ -0,0 +1,320 @@
+"""
+Benchmark the processing pipeline on a synthetic survey.
+
+Generates a survey of the requested size (participants x questions, a
+mix of bipartite and tripartite choices plus a device question and
+benchmark questions), with features produced by PathFeatures.extract on
+synthetic mouse paths, and runs the pipeline of process() against an
+in-memory stand-in for Postgres, reporting the RunMetrics of every
+stage.
+
+    python benchmark.py --participants 2000 --questions 20
+    python benchmark.py --participants 500 --trace-memory --json bench.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import features
+import process
+from metrics import RunMetrics, process_peak_rss_mib
+
+
+##############################################################################
+#
+# Synthetic survey generation.
+#
+##############################################################################
+
+
+# A normalised path from the stimulus at 0,0 to the chosen target at
+# 1,1 or -1,1, with jitter, the occasional detour into the other
+# target's quadrant and pauses long enough to register as hovers.
+def synthetic_path(rng, points):
+
+    target = rng.choice([1, -1])
+    detour = rng.random() < 0.3
+    jitter = rng.uniform(0.01, 0.1)
+
+    path = []
+    clock = 0.0
+    for i in range(points):
+        f = (i + 1) / points
+        x = target * f
+        if detour and 0.2 < f < 0.6:
+            x = -target * math.sin(f * math.pi) * 0.5
+        path.append([x + rng.gauss(0, jitter), f + rng.gauss(0, jitter), clock])
+        clock += rng.choice([8, 16, 16, 33, 250]) if rng.random() < 0.9 else 1200
+
+    path[-1][0] = target
+    path[-1][1] = 1.0
+
+    return path
+
+
+class SyntheticSurvey(object):
+
+    def __init__(self, participants=1000, questions=20, tripartite=0.3,
+                 benchmarks=2, path_pool=200, min_points=20, max_points=120, seed=1):
+
+        rng = random.Random(seed)
+        extractor = features.PathFeatures()
+
+        # Distinct feature sets, sampled per answer, so generation does
+        # not dominate the run for large surveys.
+        pool = [
+            json.dumps(extractor.extract(
+                synthetic_path(rng, rng.randint(min_points, max_points))
+            ))
+            for _ in range(path_pool)
+        ]
+
+        # qlabel -> [short_code, category, qlabel, id, qtitle, options]
+        self.question_key = {}
+        for q in range(questions):
+            category = "benchmark" if q < benchmarks else "all"
+            self.question_key[f"Q{q}"] = [f"q{q}", category, f"Q{q}", q,
+                                          f"Question '{q}'?", "Yes|No"]
+        self.question_key["DEVICE"] = ["device", "all", "DEVICE", questions,
+                                       "Which device are you using?", "Computer|Phone/Tablet"]
+
+        # Rows shaped like `select * from results`.
+        self.rows = []
+        for p in range(participants):
+            participant = f"participant-{p}"
+            for q in range(questions):
+                question_type = "tripartite_choice" if rng.random() < tripartite else "bipartite_choice"
+                self._add_row(participant, question_type, f"Question '{q}'?",
+                              rng.choice(["Yes", "No", "Don't know"]), rng.choice(pool), f"Q{q}")
+            self._add_row(participant, "single_choice", "Which device are you using?",
+                          rng.choice(["Computer", "Phone/Tablet"]), "{}", "DEVICE")
+
+    def _add_row(self, participant, question_type, stimulus, response, feats, qlabel):
+
+        row_id = len(self.rows) + 1
+        self.rows.append((row_id, row_id, participant, question_type, stimulus,
+                          response, feats, 1, qlabel))
+
+
+##############################################################################
+#
+# In-memory stand-in for the psycopg2 connection. It answers the reads
+# of a full run from the survey (the watermark, the question key and
+# the results) and counts every statement and byte sent.
+#
+##############################################################################
+
+
+def _literal(value):
+
+    if value is None:
+        return "NULL"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+
+class MemoryCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def mogrify(self, sql, args=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8")
+        if isinstance(args, dict):
+            sql = sql % {k: _literal(v) for k, v in args.items()}
+        elif args:
+            sql = sql % tuple(_literal(a) for a in args)
+        return sql.encode("utf-8")
+
+    def execute(self, sql, args=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8")
+        self.connection.statements += 1
+        self.connection.bytes_sent += len(self.mogrify(sql, args))
+
+        survey = self.connection.survey
+        statement = " ".join(sql.split()).lower()
+        if statement.startswith("select max(id) from results"):
+            self.rows = [(len(survey.rows),)]
+        elif "from known_element_of_interest" in statement:
+            self.rows = [tuple(key) for key in survey.question_key.values()]
+        elif statement.startswith("select") and "from results" in statement:
+            self.rows = list(survey.rows)
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class MemoryConnection(object):
+
+    encoding = "UTF8"
+
+    def __init__(self, survey):
+        self.survey = survey
+        self.statements = 0
+        self.bytes_sent = 0
+        self.commits = 0
+
+    def cursor(self, name=None):
+        return MemoryCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+##############################################################################
+#
+# Running the pipeline.
+#
+##############################################################################
+
+
+# RunMetrics that also records the peak Python allocations of every
+# stage with tracemalloc, which must be tracing.
+class TracedRunMetrics(RunMetrics):
+
+    def start(self, name):
+        tracemalloc.reset_peak()
+        super().start(name)
+
+    def add(self, name, wall, cpu, rows=0, rss_start_mib=None, **extra):
+        extra["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        return super().add(name, wall, cpu, rows, rss_start_mib, **extra)
+
+
+# Module settings of process overridden for the duration.
+@contextlib.contextmanager
+def _settings(**values):
+
+    saved = {name: getattr(process, name) for name in values}
+    for name, value in values.items():
+        setattr(process, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(process, name, value)
+
+
+# Run a full, uncached process._process over the survey, returning
+# the stage records of its RunMetrics and the connection used.
+def run(survey, workers=1, trace_memory=False):
+
+    metrics = TracedRunMetrics() if trace_memory else RunMetrics()
+    conn = MemoryConnection(survey)
+    cur = conn.cursor()
+
+    # The CSV export is written to the working directory.
+    with tempfile.TemporaryDirectory() as tmp, _settings(WORKERS=workers, stats_cache=None):
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            process._process(conn, cur, 1, None, False, process.INCREMENTAL_TOLERANCE,
+                             metrics)
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            os.chdir(cwd)
+
+    for record in metrics.stages:
+        record["rows_per_sec"] = record["rows"] / record["wall"] if record["wall"] else None
+
+    return metrics.stages, conn
+
+
+def report(stages, out=sys.stdout):
+
+    total = sum(s["wall"] for s in stages)
+    out.write(f"{'stage':<24}{'rows':>10}{'wall s':>10}{'cpu s':>10}{'rows/s':>14}"
+              f"{'peak MiB':>10}{'alloc MiB':>10}\n")
+    for s in stages:
+        rss = f"{s['peak_rss_mib']:.1f}" if s.get("peak_rss_mib") is not None else "-"
+        alloc = f"{s['peak_bytes'] / 2 ** 20:.1f}" if "peak_bytes" in s else "-"
+        rate = f"{s['rows_per_sec']:.0f}" if s["rows_per_sec"] else "-"
+        out.write(f"{s['stage']:<24}{s['rows']:>10}{s['wall']:>10.3f}{s['cpu']:>10.3f}{rate:>14}"
+                  f"{rss:>10}{alloc:>10}\n")
+        # Parts of a stage timed apart, e.g. fetch, unpack and stats
+        # of the read stage; not counted in the total again.
+        for part, (wall, cpu) in s.get("parts", {}).items():
+            rate = f"{s['rows'] / wall:.0f}" if wall else "-"
+            out.write(f"{'  ' + s['stage'] + '.' + part:<24}{s['rows']:>10}{wall:>10.3f}{cpu:>10.3f}"
+                      f"{rate:>14}\n")
+    out.write(f"{'total':<24}{'':>10}{total:>10.3f}\n")
+    out.write(f"process peak RSS {process_peak_rss_mib():.1f} MiB\n")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--participants", type=int, default=1000)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--tripartite", type=float, default=0.3,
+                        help="share of choice questions that are tripartite")
+    parser.add_argument("--benchmarks", type=int, default=2,
+                        help="questions in the benchmark category")
+    parser.add_argument("--path-pool", type=int, default=200,
+                        help="distinct synthetic paths to extract features from")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to normalise and score over")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the peak of Python allocations held during each stage (slower)")
+    parser.add_argument("--json", help="write the stage records to this file")
+    args = parser.parse_args(argv)
+
+    generated = time.perf_counter()
+    survey = SyntheticSurvey(args.participants, args.questions, args.tripartite,
+                             args.benchmarks, args.path_pool, seed=args.seed)
+    generated = time.perf_counter() - generated
+    print(f"Generated {len(survey.rows)} rows for {args.participants} participants "
+          f"in {generated:.2f}s")
+
+    # Keep the pipeline's own logging out of the report.
+    process.logging.disable(process.logging.INFO)
+    process.logger.disabled = True
+
+    stages, conn = run(survey, args.workers, args.trace_memory)
+    report(stages)
+    print(f"{conn.statements} statements, {conn.bytes_sent} bytes sent, "
+          f"{conn.commits} commits")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "stages": stages, "statements": conn.statements,
+                       "bytes_sent": conn.bytes_sent}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Extract features from raw mouse paths in bulk.
+
+Reads raw paths from JSON-lines or Parquet files, normalises them as
+bipartite or tripartite answers and extracts their features over a
+process pool, writing one JSON line per path with the features in the
+shape stored in results.features:
+
+    {"id": ..., "features": {"diverge": {...}, "hover": {...}, ...}}
+
+or, where a path cannot be normalised or extracted,
+
+    {"id": ..., "error": "..."}
+
+Every input record holds an id, the raw path as [time, x, y] points and
+its question_type. Tripartite answers also need the question's options
+(option title -> option key) and the response. Paths and options may
+be stored as JSON strings.
+
+Work is split into chunks of --chunk-size records, each written to its
+own part file in the output directory. Parts already there are
+skipped, so an interrupted run picks up where it stopped when run
+again with the same inputs and chunk size.
+
+    python extract.py paths.jsonl --out features/
+    python extract.py a.parquet b.parquet --out features/ --workers 8 --families diverge hover
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import features
+import geometry as geo
+
+# pyarrow is optional; it is only needed for Parquet input.
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+TRIPARTITE = "tripartite_choice"
+
+
+##############################################################################
+#
+# Reading input records.
+#
+##############################################################################
+
+
+# Records of a JSON-lines file, chunk_size at a time.
+def _read_jsonl(filename, chunk_size):
+
+    chunk = []
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+
+# Records of a Parquet file, chunk_size at a time.
+def _read_parquet(filename, chunk_size):
+
+    if pq is None:
+        raise RuntimeError("Reading Parquet files needs pyarrow installed.")
+
+    for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunk_size):
+        yield batch.to_pylist()
+
+
+def read_chunks(filename, chunk_size):
+
+    if filename.endswith((".parquet", ".pq")):
+        return _read_parquet(filename, chunk_size)
+
+    return _read_jsonl(filename, chunk_size)
+
+
+def _decoded(value):
+    return json.loads(value) if isinstance(value, (str, bytes)) else value
+
+
+# The path, options and response of a record, decoded, with the path
+# checked to be [time, x, y] points so that a malformed record fails on
+# its own rather than its whole batch. Options and responses are
+# checked per path by tripartiteNormPaths. Raises ValueError or
+# TypeError for a record that cannot be read.
+def _checked(record, fields, tripartite):
+
+    path = _decoded(record.get(fields["path"])) or []
+    np.array([point[:3] for point in path], dtype=float).reshape(-1, 3)
+
+    if not tripartite:
+        return path, None, None
+
+    options = _decoded(record.get(fields["options"]))
+    response = record.get(fields["response"])
+
+    return path, options, response
+
+
+##############################################################################
+#
+# Extraction, run in the worker processes.
+#
+##############################################################################
+
+
+# Normalise and extract the features of a chunk of records, returning
+# one output dict per record in order.
+def extract_records(records, fields, families=features.FAMILIES):
+
+    tripartite = [r.get(fields["question_type"]) == TRIPARTITE for r in records]
+
+    # Normalised path or normalisation error of every record, with
+    # bipartite and tripartite answers each normalised as one batch.
+    paths = [None] * len(records)
+    errors = {}
+
+    checked = {}
+    for i, record in enumerate(records):
+        try:
+            checked[i] = _checked(record, fields, tripartite[i])
+        except (TypeError, ValueError, IndexError) as err:
+            errors[i] = err
+
+    for kind in (False, True):
+
+        indices = [i for i in checked if tripartite[i] == kind]
+        if not indices:
+            continue
+
+        batch = geo.PathBatch.fromPaths([checked[i][0] for i in indices])
+
+        if kind:
+            options = [checked[i][1] for i in indices]
+            responses = [checked[i][2] for i in indices]
+            norm, failed = geo.tripartiteNormPaths(batch, options, responses)
+        else:
+            norm, failed = geo.bipartiteNormPaths(batch)
+
+        for k, i in enumerate(indices):
+            if k in failed:
+                errors[i] = failed[k]
+            else:
+                paths[i] = norm.path(k)
+
+    extractor = features.FastPathFeatures()
+
+    out = []
+    for i, record in enumerate(records):
+
+        row = {"id": record.get(fields["id"])}
+
+        if i in errors:
+            row["error"] = repr(errors[i])
+        else:
+            try:
+                row["features"] = extractor.extract(paths[i], families)
+            except (ArithmeticError, ValueError) as err:
+                row["error"] = repr(err)
+
+        out.append(row)
+
+    return out
+
+
+# Extract a chunk and write it to its part file, returning the
+# number of records and of errors.
+def write_part(records, part, fields, families):
+
+    rows = extract_records(records, fields, families)
+
+    # Written aside and moved into place, so a part file is only
+    # there once it is complete.
+    tmp = part + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row))
+            f.write("\n")
+    os.replace(tmp, part)
+
+    return len(rows), sum("error" in row for row in rows)
+
+
+##############################################################################
+#
+# Driving the pool.
+#
+##############################################################################
+
+
+def part_name(out_dir, file_index, filename, chunk_index):
+
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(out_dir, f"{file_index:03d}-{stem}-{chunk_index:06d}.jsonl")
+
+
+def run(inputs, out_dir, fields, families=features.FAMILIES, workers=None,
+        chunk_size=1000, out=sys.stdout):
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    records = errors = skipped = 0
+    started = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+
+        # Only a few chunks per worker are read ahead, so memory
+        # stays bounded however large the input.
+        pending = set()
+
+        def collect(wait_for):
+            nonlocal records, errors
+            done, rest = concurrent.futures.wait(wait_for, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                n, failed = future.result()
+                records += n
+                errors += failed
+            return rest
+
+        for file_index, filename in enumerate(inputs):
+            for chunk_index, chunk in enumerate(read_chunks(filename, chunk_size)):
+
+                part = part_name(out_dir, file_index, filename, chunk_index)
+                if os.path.exists(part):
+                    skipped += 1
+                    continue
+
+                if len(pending) >= 2 * workers:
+                    pending = collect(pending)
+
+                pending.add(pool.submit(write_part, chunk, part, fields, families))
+
+        while pending:
+            pending = collect(pending)
+
+    elapsed = time.perf_counter() - started
+    out.write(f"Extracted {records} paths ({errors} errors) in {elapsed:.2f}s, "
+              f"{skipped} chunks already done\n")
+
+    return records, errors
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="+", help="JSON-lines or Parquet files of raw paths")
+    parser.add_argument("--out", required=True, help="directory for the part files")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="records per chunk and part file")
+    parser.add_argument("--families", nargs="+", default=list(features.FAMILIES),
+                        choices=features.FAMILIES, help="feature families to extract")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--path-field", default="path")
+    parser.add_argument("--question-type-field", default="question_type")
+    parser.add_argument("--options-field", default="options")
+    parser.add_argument("--response-field", default="response")
+    args = parser.parse_args(argv)
+
+    fields = {
+        "id": args.id_field,
+        "path": args.path_field,
+        "question_type": args.question_type_field,
+        "options": args.options_field,
+        "response": args.response_field,
+    }
+
+    run(args.inputs, args.out, fields, args.families, args.workers, args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
 from features.features import *
 from features.stats import *
+from features.fast import *
@@ -0,0 +1,796 @@
+import math
+
+import numpy as np
+
+import geometry as geo
+
+##############################################################################
+#
+# Array based implementations of the PathFeatures extractors. Paths are
+# (n,3) float arrays of x, y, time, and every extractor returns exactly
+# the same feature dict as its PathFeatures counterpart.
+#
+# Sums are accumulated in path order (np.cumsum) rather than with
+# np.sum's pairwise summation, so totals round the same way as the
+# original running totals.
+#
+##############################################################################
+
+
+# Convert a path of [x, y, time] points to an (n,3) float array.
+def as_path_array(path):
+
+    arr = np.asarray(path, dtype=float)
+
+    if arr.size == 0:
+        return np.empty((0, 3))
+
+    if arr.ndim != 2 or arr.shape[1] < 3:
+        raise ValueError("Paths must be a sequence of [x, y, time] points.")
+
+    return arr[:, :3]
+
+
+# Quadrant of each point: 1,2,3,4 clockwise from top right,
+# split at x = 0 and y = 0.5 as in PathFeatures.
+def quadrants(x, y):
+
+    return np.select(
+        [(x >= 0) & (y < 0.5), (x < 0) & (y < 0.5), (x < 0) & (y >= 0.5)],
+        [2, 3, 4],
+        default=1,
+    )
+
+
+# Sequential (left to right) total of an array.
+def running_total(values):
+
+    return np.cumsum(values)[-1] if len(values) else 0.0
+
+
+# Vectorised geometry.orientation: 0 colinear, 1 clockwise,
+# 2 counterclockwise for every triplet (p, q, r).
+def _orientation(px, py, qx, qy, rx, ry):
+
+    val = (qy - py) * (rx - qx) - (qx - px) * (ry - qy)
+
+    return np.where(val == 0, 0, np.where(val > 0, 1, 2))
+
+
+# Vectorised geometry.onSegment.
+def _on_segment(px, py, qx, qy, rx, ry):
+
+    return (
+        (qx <= np.maximum(px, rx))
+        & (qx >= np.minimum(px, rx))
+        & (qy <= np.maximum(py, ry))
+        & (qy >= np.minimum(py, ry))
+    )
+
+
+# Vectorised geometry.doIntersect for segments p1q1 and p2q2.
+def _do_intersect(p1x, p1y, q1x, q1y, p2x, p2y, q2x, q2y):
+
+    o1 = _orientation(p1x, p1y, q1x, q1y, p2x, p2y)
+    o2 = _orientation(p1x, p1y, q1x, q1y, q2x, q2y)
+    o3 = _orientation(p2x, p2y, q2x, q2y, p1x, p1y)
+    o4 = _orientation(p2x, p2y, q2x, q2y, q1x, q1y)
+
+    return (
+        ((o1 != o2) & (o3 != o4))
+        | ((o1 == 0) & _on_segment(p1x, p1y, p2x, p2y, q1x, q1y))
+        | ((o2 == 0) & _on_segment(p1x, p1y, q2x, q2y, q1x, q1y))
+        | ((o3 == 0) & _on_segment(p2x, p2y, p1x, p1y, q2x, q2y))
+        | ((o4 == 0) & _on_segment(p2x, p2y, q1x, q1y, q2x, q2y))
+    )
+
+
+# Most candidate pairs generated and tested at once. Candidates come
+# in blocks of about this many, so memory stays bounded however many
+# segments share a grid cell or a line.
+CROSSING_BLOCK_PAIRS = 2 ** 17
+
+
+# Pairs (a, b) for rows a with counts[a] pairs each, b running from
+# base[a] to base[a] + counts[a] - 1, in blocks of rows holding about
+# CROSSING_BLOCK_PAIRS pairs (a row with more is a block of its own).
+def _pair_blocks(counts, base):
+
+    if not len(counts):
+        return
+
+    start = np.cumsum(counts) - counts
+    block = start // CROSSING_BLOCK_PAIRS
+    edges = np.concatenate(([0], np.flatnonzero(np.diff(block)) + 1, [len(counts)]))
+
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        rows = counts[lo:hi]
+        a = np.repeat(np.arange(lo, hi), rows)
+        b = base[a] + np.arange(len(a)) - np.repeat(start[lo:hi] - start[lo], rows)
+        yield a, b
+
+
+# Every pair (i, j) of n segments with j >= i + 2.
+def _all_pairs(n):
+
+    i = np.arange(n)
+    return _pair_blocks(np.maximum(n - 2 - i, 0), i + 2)
+
+
+# Candidate pairs (i, j), i < j, of segments whose bounding boxes
+# overlap. Boxes are bucketed on a uniform grid and only pairs sharing
+# a cell are kept; a pair is only taken from the cell holding the
+# lower-left corner of the overlap of its boxes, so it is found once.
+# The grid starts at sqrt(n) cells a side and is made coarser while
+# the boxes would cover more than 8 cells each on average.
+def _grid_pairs(xmin, xmax, ymin, ymax):
+
+    n = len(xmin)
+    x0, y0 = xmin.min(), ymin.min()
+
+    cells = max(1, int(math.sqrt(n)))
+    while True:
+        width = (xmax.max() - x0) / cells or 1.0
+        height = (ymax.max() - y0) / cells or 1.0
+
+        cx0 = np.clip(np.floor((xmin - x0) / width).astype(np.int64), 0, cells - 1)
+        cx1 = np.clip(np.floor((xmax - x0) / width).astype(np.int64), 0, cells - 1)
+        cy0 = np.clip(np.floor((ymin - y0) / height).astype(np.int64), 0, cells - 1)
+        cy1 = np.clip(np.floor((ymax - y0) / height).astype(np.int64), 0, cells - 1)
+
+        # Expand every segment into the cells its box covers.
+        spans_x = cx1 - cx0 + 1
+        counts = spans_x * (cy1 - cy0 + 1)
+        if cells == 1 or counts.sum() <= 8 * n:
+            break
+        cells //= 2
+
+    seg = np.repeat(np.arange(n), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell = (cx0[seg] + offset % spans_x[seg]) * cells + cy0[seg] + offset // spans_x[seg]
+
+    order = np.lexsort((seg, cell))
+    seg, cell = seg[order], cell[order]
+    bounds = np.flatnonzero(np.diff(cell)) + 1
+    ends = np.concatenate((bounds, [len(cell)]))
+
+    # Pair every entry with each later entry of its cell. Segments
+    # are sorted within a cell, so i < j.
+    end = np.repeat(ends, np.diff(np.concatenate(([0], ends))))
+    entries = np.arange(len(cell))
+
+    def pairs():
+        for a, b in _pair_blocks(end - entries - 1, entries + 1):
+            i, j, here = seg[a], seg[b], cell[a]
+
+            keep = np.maximum(cx0[i], cx0[j]) * cells + np.maximum(cy0[i], cy0[j]) == here
+            keep &= (xmin[i] <= xmax[j]) & (xmin[j] <= xmax[i])
+            keep &= (ymin[i] <= ymax[j]) & (ymin[j] <= ymax[i])
+
+            yield i[keep], j[keep]
+
+    return pairs()
+
+
+# Candidate pairs (i, j), i < j, of segments lying on nearly the same
+# line, matched on direction and distance of the line from the origin
+# (both relative to scale) to within tolerance. Each pair is found
+# once.
+def _collinear_pairs(px, py, x, y, scale, tolerance):
+
+    dx, dy = x - px, y - py
+    seg = np.flatnonzero((dx != 0) | (dy != 0))
+    theta = np.arctan2(dy[seg], dx[seg]) % np.pi
+    d = (np.cos(theta) * py[seg] - np.sin(theta) * px[seg]) / scale
+
+    # Directions just short of pi also match those just above 0,
+    # with the line's normal, and so its distance, flipped. Two such
+    # copies are never paired, as their originals already are.
+    wrap = theta > np.pi - 2 * tolerance
+    copy = np.concatenate((np.zeros(len(seg), dtype=bool), np.ones(wrap.sum(), dtype=bool)))
+    seg = np.concatenate((seg, seg[wrap]))
+    theta = np.concatenate((theta, theta[wrap] - np.pi))
+    d = np.concatenate((d, -d[wrap]))
+
+    # Bucket on direction, then order by distance within a bucket.
+    # Distances are within +/-1.5, so bucket * 4 + distance + 2 sorts
+    # by bucket first and the pairs to match on are the keys within
+    # tolerance in the same bucket or the next one, all later in
+    # the order.
+    key = np.floor(theta / tolerance) * 4 + d + 2
+    order = np.argsort(key, kind="stable")
+    seg, key, copy = seg[order], key[order], copy[order]
+    entries = np.arange(len(key))
+
+    same = np.searchsorted(key, key + tolerance, side="right")
+    lo = np.searchsorted(key, key + 4 - tolerance, side="left")
+    hi = np.searchsorted(key, key + 4 + tolerance, side="right")
+
+    for counts, base in ((same - entries - 1, entries + 1), (hi - lo, lo)):
+        for a, b in _pair_blocks(counts, base):
+            keep = ~(copy[a] & copy[b])
+            i, j = seg[a][keep], seg[b][keep]
+            yield np.minimum(i, j), np.maximum(i, j)
+
+
+# Count the pairs of segments (i, j), i < j - 1, that intersect,
+# where segment k runs from point k-1 to point k (segment 0 from
+# the origin). This is the pathCrossing count of divergence.
+#
+# Rather than testing every pair, which is quadratic, candidates
+# are the pairs whose bounding boxes (nearly) overlap plus the pairs
+# that are (nearly) collinear, which for mouse paths is near linear.
+# Collinear pairs whose boxes overlap are left to the grid, so no
+# pair is counted twice. Every candidate is then tested with
+# doIntersect, with the pair in the same argument order as the
+# original loop.
+#
+# doIntersect can report crossings between collinear segments that
+# are far apart, when rounding gives their orientations different
+# signs. Such a pair must lie on nearly the same line, so it is
+# among the collinear candidates and counted exactly as before: the
+# grid slack and tolerances below are orders of magnitude wider than
+# the rounding error of the orientation test.
+#
+# Paths of up to CROSSING_PAIRS_LIMIT segments are short enough that
+# testing every pair is cheaper than finding the candidates.
+CROSSING_PAIRS_LIMIT = 96
+
+
+def count_crossings(x, y):
+
+    n = len(x)
+    if n < 3:
+        return 0
+
+    px = np.concatenate(([0.0], x[:-1]))
+    py = np.concatenate(([0.0], y[:-1]))
+
+    def hits(i, j):
+        keep = j - i >= 2
+        i, j = i[keep], j[keep]
+        return int(np.count_nonzero(
+            _do_intersect(px[i], py[i], x[i], y[i], px[j], py[j], x[j], y[j])
+        ))
+
+    if n <= CROSSING_PAIRS_LIMIT:
+        return sum(hits(i, j) for i, j in _all_pairs(n))
+
+    scale = max(np.abs(x).max(), np.abs(y).max()) or 1.0
+
+    slack = scale * 1e-6
+    xmin, xmax = np.minimum(px, x) - slack, np.maximum(px, x) + slack
+    ymin, ymax = np.minimum(py, y) - slack, np.maximum(py, y) + slack
+
+    count = sum(hits(i, j) for i, j in _grid_pairs(xmin, xmax, ymin, ymax))
+
+    for i, j in _collinear_pairs(px, py, x, y, scale, 1e-6):
+        apart = (xmin[i] > xmax[j]) | (xmin[j] > xmax[i]) | (ymin[i] > ymax[j]) | (ymin[j] > ymax[i])
+        count += hits(i[apart], j[apart])
+
+    return count
+
+
+# The windows PathFeatures.hover examines, as start and (inclusive)
+# end indices: for each start, the first index more than period
+# after it, with both ends stepped forward exactly as in its loop.
+# Every start is examined once whatever the outcome, so the windows
+# only depend on the times.
+def hover_windows(times, period):
+
+    starts, ends = [], []
+    n = len(times)
+    start = index = 0
+
+    while start < n and index < n:
+        if times[index] - times[start] <= period:
+            index += 1
+            continue
+
+        while times[index] - times[start] > period:
+            starts.append(start)
+            ends.append(index)
+            start += 1
+
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+# Sparse tables for range maxima over the rows of values: level l
+# holds the maximum of every run of 2 ** l rows.
+def _range_tables(values):
+
+    tables = [values]
+    width = 1
+    while width * 2 <= len(values):
+        prev = tables[-1]
+        tables.append(np.maximum(prev[:-width], prev[width:]))
+        width *= 2
+
+    return tables
+
+
+# Maximum of the rows starts..ends (inclusive) for every window,
+# as the larger of two overlapping power of two runs.
+def _range_max(tables, starts, ends):
+
+    # frexp gives the exact bit length of each window length.
+    level = np.frexp((ends - starts + 1).astype(float))[1] - 1
+    out = np.empty((len(starts),) + tables[0].shape[1:])
+
+    for l in np.unique(level):
+        sel = level == l
+        table = tables[l]
+        out[sel] = np.maximum(table[starts[sel]], table[ends[sel] - (1 << int(l)) + 1])
+
+    return out
+
+
+# Centre of the window as PathFeatures.hover computes it, summing
+# in order and dividing by one less than the number of points.
+def _window_center(path, start, end):
+
+    avg_x = 0
+    avg_y = 0
+
+    for point in path[start : end + 1]:
+        avg_x += point[0]
+        avg_y += point[1]
+
+    return geo.Point(avg_x / (end - start), avg_y / (end - start))
+
+
+def _window_is_hover(path, start, end, center, space):
+
+    for point in path[start : end + 1]:
+        if geo.pointToPoint(geo.Point(point[0], point[1]), center) > space:
+            return False
+
+    return True
+
+
+# Unit vectors the window extents are measured along. The points
+# of a window lie in the regular 16-gon around its centre whose
+# inradius is the largest extent, so their furthest distance from
+# the centre is between that extent and the extent / cos(pi / 16).
+HOVER_DIRECTIONS = np.arange(8) * np.pi / 8
+HOVER_BOUND = 1 / math.cos(np.pi / 16)
+
+
+# The shape grid is 43 x 25 cells, indexed [x][y], with the origin
+# at 21,3 and the targets at 3/39,21 (see PathFeatures.shape).
+SHAPE_GRID = (43, 25)
+
+
+# Grid cells of every point of the path, as PathFeatures.shape
+# places them.
+def shape_cells(x, y):
+
+    sx = x * 18
+    sy = y * 18
+
+    gx = np.where(np.abs(sx) < 21, np.trunc(sx) + 21, np.where(x > 0, 42, 0))
+    gy = np.maximum(np.where(sy < 21, np.trunc(sy) + 3, 24), 0)
+
+    return gx.astype(np.int64), gy.astype(np.int64)
+
+
+# Cells sampled along the lines between consecutive cells, one per
+# step along the longer axis, in a single pass for all four slopes.
+# As in PathFeatures.shape, only moves of two or more cells right or
+# up are drawn, which leaves the "both down" case out.
+def rasterize(gx, gy):
+
+    x0, y0 = gx[:-1], gy[:-1]
+    dx, dy = gx[1:] - x0, gy[1:] - y0
+
+    draw = ~((dx < 2) & (dy < 2))
+    x0, y0, dx, dy = x0[draw], y0[draw], dx[draw], dy[draw]
+
+    across = np.abs(dx) > np.abs(dy)
+    steps = np.maximum(np.abs(dx), np.abs(dy))
+    ratio = np.minimum(np.abs(dx), np.abs(dy)) / steps
+
+    seg = np.repeat(np.arange(len(steps)), steps)
+    k = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+
+    # The minor axis moves by k * ratio, truncated.
+    sx, sy = np.sign(dx)[seg], np.sign(dy)[seg]
+    minor = k * ratio[seg]
+    across = across[seg]
+
+    cx = np.where(across, x0[seg] + sx * k, np.trunc(x0[seg] + sx * minor))
+    cy = np.where(across, np.trunc(y0[seg] + sy * minor), y0[seg] + sy * k)
+
+    return cx.astype(np.int64), cy.astype(np.int64)
+
+
+# The PathFeatures.shape key of each 9 bit pattern code. Codes hold
+# the window top row first, left to right, from bit 8 down to bit 0;
+# keys spell the same cells as digits, 2 lit and 1 not, as a float.
+SHAPE_KEYS = [
+    float(sum((((code >> (8 - i)) & 1) + 1) * 10 ** (8 - i) for i in range(9)))
+    for code in range(512)
+]
+
+
+# 9 bit code and number of lit cells of every 3x3 window of the
+# grid, as arrays indexed [y][x] by the window's first cell.
+def pattern_codes(grid):
+
+    w, h = grid.shape[0] - 2, grid.shape[1] - 2
+    codes = np.zeros((w, h), dtype=np.int64)
+    marked = np.zeros((w, h), dtype=np.int64)
+
+    for b in range(3):
+        for a in range(3):
+            cell = grid[a : a + w, b : b + h]
+            codes |= cell.astype(np.int64) << (8 - (b * 3 + a))
+            marked += cell
+
+    return codes.T, marked.T
+
+
+# The feature families of PathFeatures.extract, in its order.
+FAMILIES = ("diverge", "hover", "speed", "shape")
+
+
+##############################################################################
+#
+# PathArrays holds a path converted to arrays once, with the
+# intermediates several extractors share, so that extracting every
+# family walks the path's points once rather than once per family.
+# Intermediates only one family needs are worked out on first use.
+#
+##############################################################################
+
+
+class PathArrays(object):
+
+    def __init__(self, path):
+
+        self.path = path
+        self.arr = as_path_array(path)
+        self.x, self.y, self.t = self.arr[:, 0], self.arr[:, 1], self.arr[:, 2]
+        self.n = len(self.arr)
+
+        # Early actions are in the first third of overall time,
+        # late actions in the last third.
+        self.early = path[-1][2] / 3
+        self.late = self.early * 2
+        self.early_mask = self.t < self.early
+        self.late_mask = self.t > self.late
+
+        self._steps = None
+        self._quads = None
+
+    # Length of every step, the first from the origin. float_power
+    # calls the C pow() as geometry.pointToPoint does, where ** 2
+    # squares and can differ in the last bit.
+    @property
+    def steps(self):
+
+        if self._steps is None:
+            lx = np.concatenate(([0.0], self.x[:-1]))
+            ly = np.concatenate(([0.0], self.y[:-1]))
+            self._steps = np.sqrt(
+                np.float_power(np.abs(self.x - lx), 2) + np.float_power(np.abs(self.y - ly), 2)
+            )
+
+        return self._steps
+
+    @property
+    def quads(self):
+
+        if self._quads is None:
+            self._quads = quadrants(self.x, self.y)
+
+        return self._quads
+
+
+def _path_arrays(path):
+
+    return path if isinstance(path, PathArrays) else PathArrays(path)
+
+
+class FastPathFeatures(object):
+
+    # Run the extractors of the given families on the path, sharing
+    # one PathArrays between them. With every family, this returns
+    # what PathFeatures.extract does.
+    def extract(self, path, families=FAMILIES):
+
+        unknown = set(families) - set(FAMILIES)
+        if unknown:
+            raise ValueError(f"Unknown feature families: {sorted(unknown)}")
+
+        features = {}
+
+        if len(path) == 0:
+            return features
+
+        arrays = PathArrays(path)
+        extractors = {
+            "diverge": self.divergence,
+            "hover": self.hover,
+            "speed": self.speed,
+            "shape": self.shape,
+        }
+
+        for family in FAMILIES:
+            if family in families:
+                features[family] = extractors[family](arrays)
+
+        return features
+
+    # To what extent is the path to the final
+    # decision not straight? See PathFeatures.divergence.
+    def divergence(self, path):
+
+        p = _path_arrays(path)
+        x, y, t = p.x, p.y, p.t
+        n = p.n
+
+        bx, by = float(x[-1]), float(y[-1])
+        homeQuad = 1 if bx > 0 else 4
+
+        # Distance of every point from the straight line between
+        # the origin and the final point (geometry.pointToLine).
+        denominator = math.sqrt(pow(by - 0, 2) + pow(bx - 0, 2))
+        if denominator:
+            divr = np.abs((by - 0) * x - (bx - 0) * y + bx * 0 - by * 0) / denominator
+            cumulativeDivergence = float(running_total(divr))
+            maxDivergence = float(divr.max()) if divr.max() > 0 else 0
+        else:
+            cumulativeDivergence = 0
+            maxDivergence = 0
+
+        dist = p.steps
+        totalDistance = float(running_total(dist))
+
+        quads = p.quads
+
+        quadTotalDistance = [0, 0, 0, 0]
+        for q in range(1, 5):
+            mask = quads == q
+            if mask.any():
+                quadTotalDistance[q - 1] = float(running_total(np.where(mask, dist, 0.0)))
+
+        # Runs of consecutive points within one quadrant.
+        changes = np.flatnonzero(quads[1:] != quads[:-1]) + 1
+        starts = np.concatenate(([0], changes))
+        ends = np.concatenate((changes, [n]))
+        runs = quads[starts]
+
+        otherQuadrant = False
+        otherQuadEarly = False
+        otherQuadLate = False
+        if homeQuad == 1:
+            entered = changes[(quads[changes] == 3) | (quads[changes] == 4)]
+            otherQuadrant = bool(len(entered))
+            otherQuadEarly = bool(p.early_mask[entered].any())
+            otherQuadLate = bool(p.late_mask[entered].any())
+
+        # Distances only grow within a run, so the longest stretch
+        # is decided by each run's total; ties keep the earlier run.
+        quadMaxDistance = float(running_total(dist[starts[0] : ends[0]]))
+        quadMaxIndex = int(runs[0])
+        for s, e, q in zip(starts[1:], ends[1:], runs[1:]):
+            total = float(running_total(dist[s:e]))
+            if total > quadMaxDistance:
+                quadMaxDistance = total
+                quadMaxIndex = int(q)
+
+        # Moves between the right (1,2) and left (3,4) quadrants.
+        right = (runs == 1) | (runs == 2)
+        numBackAndForth = int(np.count_nonzero(right[1:] != right[:-1]))
+
+        return {
+            "cumulativeDivergence": [cumulativeDivergence, "series"],
+            "averageDivergence": [cumulativeDivergence / n, "series"],
+            "totalDistance": [totalDistance, "series"],
+            "pathCrossing": [count_crossings(x, y), "series"],
+            "maxDivergence": [maxDivergence, "series"],
+            "otherQuadrant": [otherQuadrant, "bool"],
+            "otherQuadEarly": [otherQuadEarly, "bool"],
+            "otherQuadLate": [otherQuadLate, "bool"],
+            "quadTotalDistance1": [quadTotalDistance[0], "series"],
+            "quadTotalDistance2": [quadTotalDistance[1], "series"],
+            "quadTotalDistance3": [quadTotalDistance[2], "series"],
+            "quadTotalDistance4": [quadTotalDistance[3], "series"],
+            "quadMaxDistance": [quadMaxDistance, "series"],
+            "quadMaxIndex": [quadMaxIndex, "class"],
+            "numBackAndForth": [numBackAndForth, "series"],
+        }
+
+    # Did she hover over the stimulus? See PathFeatures.hover.
+    #
+    # Rather than re-averaging every window, window centres come from
+    # prefix sums and their extents from range maxima of the points
+    # projected along HOVER_DIRECTIONS, for all windows at once. The
+    # prefix sums round differently from the in-order sums, so every
+    # decision allows for a margin of error, bounded from the path's
+    # length and magnitude, and the few windows whose outcome falls
+    # within it are decided with the original computation.
+    def hover(self, path):
+
+        p = _path_arrays(path)
+        path = p.path
+
+        earlyHover = False
+        lateHover = False
+        numHover = 0
+        stimulusHover = False
+        targetHover = False
+        otherHover = False
+        upperHover = False
+        lowerHover = False
+        otherQuadHover = False
+
+        hoverPeriod = 1000
+        hoverSpace = 0.05
+        assocDist = 0.1
+
+        early = p.early
+        late = p.late
+
+        stimulus = geo.Point(0, 0)
+        if path[-1][0] > 0:
+            target = geo.Point(1, 1)
+            other = geo.Point(-1, 1)
+            homeQuad = 1
+        else:
+            target = geo.Point(-1, 1)
+            other = geo.Point(1, 1)
+            homeQuad = 4
+
+        arr = p.arr
+        x, y = p.x, p.y
+        n = p.n
+
+        starts, ends = hover_windows([point[2] for point in path], hoverPeriod)
+
+        hover = np.zeros(len(starts), dtype=bool)
+        if len(starts):
+            sum_x = np.concatenate(([0.0], np.cumsum(x)))
+            sum_y = np.concatenate(([0.0], np.cumsum(y)))
+            count = ends - starts
+            cx = (sum_x[ends + 1] - sum_x[starts]) / count
+            cy = (sum_y[ends + 1] - sum_y[starts]) / count
+
+            # Bound on the error of each centre against the in-order
+            # sums, with room for the rounding of the distances.
+            eps = np.finfo(float).eps
+            scale = max(1.0, float(np.abs(arr[:, :2]).max()))
+            total = float(np.abs(x).sum() + np.abs(y).sum())
+            margin = 4 * (4 * n * eps * total / count + 4 * eps * scale) + 1e-12 * scale
+
+            ux, uy = np.cos(HOVER_DIRECTIONS), np.sin(HOVER_DIRECTIONS)
+            proj = np.outer(x, ux) + np.outer(y, uy)
+            centre = np.outer(cx, ux) + np.outer(cy, uy)
+            high = _range_max(_range_tables(proj), starts, ends) - centre
+            low = centre + _range_max(_range_tables(-proj), starts, ends)
+            extent = np.maximum(high, low).max(axis=1)
+
+            hover = extent * HOVER_BOUND < hoverSpace - margin
+            unsure = ~hover & (extent <= hoverSpace + margin)
+
+            for w in np.flatnonzero(unsure):
+                s, e = int(starts[w]), int(ends[w])
+                hover[w] = _window_is_hover(path, s, e, _window_center(path, s, e), hoverSpace)
+
+        lastHover = None
+
+        for w in np.flatnonzero(hover):
+            s, e = int(starts[w]), int(ends[w])
+
+            # Same place as the last hover?
+            if lastHover:
+                near = math.sqrt((lastHover.x - cx[w]) ** 2 + (lastHover.y - cy[w]) ** 2)
+                if near < assocDist - margin[w]:
+                    continue
+                if near <= assocDist + margin[w]:
+                    if geo.pointToPoint(lastHover, _window_center(path, s, e)) < assocDist:
+                        continue
+
+            clusterCenter = _window_center(path, s, e)
+
+            numHover += 1
+
+            if (path[s][2] + path[e][2]) / 2 < early:
+                earlyHover = True
+
+            if (path[s][2] + path[e][2]) / 2 > late:
+                lateHover = True
+
+            if geo.pointToPoint(stimulus, clusterCenter) < assocDist:
+                stimulusHover = True
+
+            if geo.pointToPoint(target, clusterCenter) < assocDist:
+                targetHover = True
+
+            if geo.pointToPoint(other, clusterCenter) < assocDist:
+                otherHover = True
+
+            currentQuad = 1
+            if clusterCenter.x >= 0 and clusterCenter.y < 0.5:
+                currentQuad = 2
+            elif clusterCenter.x < 0 and clusterCenter.y < 0.5:
+                currentQuad = 3
+            elif clusterCenter.x < 0 and clusterCenter.y >= 0.5:
+                currentQuad = 4
+
+            if currentQuad in [1, 4]:
+                upperHover = True
+
+            if currentQuad in [2, 3]:
+                lowerHover = True
+
+            if upperHover and homeQuad != currentQuad:
+                otherQuadHover = True
+
+            lastHover = clusterCenter
+
+        return {
+            "earlyHover": [earlyHover, "bool"],
+            "lateHover": [lateHover, "bool"],
+            "numHover": [numHover, "series"],
+            "stimulusHover": [stimulusHover, "bool"],
+            "targetHover": [targetHover, "bool"],
+            "otherHover": [otherHover, "bool"],
+            "upperHover": [upperHover, "bool"],
+            "lowerHover": [lowerHover, "bool"],
+            "otherQuadHover": [otherQuadHover, "bool"],
+        }
+
+    # How does the speed behave? See PathFeatures.speed.
+    #
+    # As there, every speed is the distance of the point from the
+    # origin over its time (1 for time 0), stamped with its time.
+    def speed(self, path):
+
+        p = _path_arrays(path)
+
+        time = np.where(p.t == 0, 1, p.t)
+        speeds = np.sqrt(np.float_power(np.abs(p.x), 2) + np.float_power(np.abs(p.y), 2)) / time
+
+        # Stamps are the times, so early and late speeds are those
+        # of the early and late points.
+        earlySpeeds = int(np.count_nonzero(p.early_mask))
+        lateSpeeds = int(np.count_nonzero(p.late_mask))
+        earlySpeed = float(running_total(speeds[p.early_mask])) if earlySpeeds else 0
+        lateSpeed = float(running_total(speeds[p.late_mask])) if lateSpeeds else 0
+
+        averageSpeed = float(running_total(speeds)) / p.n
+        maxSpeed = float(speeds.max()) if speeds.max() > 0 else 0
+        variance = float(running_total(np.float_power(speeds - averageSpeed, 2))) / p.n
+
+        return {
+            "earlySpeed": [earlySpeed / earlySpeeds, "series"],
+            "lateSpeed": [lateSpeed / lateSpeeds, "series"],
+            "averageSpeed": [averageSpeed, "series"],
+            "maxSpeed": [maxSpeed, "series"],
+            "variance": [variance, "series"],
+        }
+
+    # What shape was the path? See PathFeatures.shape.
+    def shape(self, path):
+
+        p = _path_arrays(path)
+
+        grid = np.zeros(SHAPE_GRID, dtype=np.uint8)
+
+        gx, gy = shape_cells(p.x, p.y)
+        grid[gx, gy] = 1
+
+        lx, ly = rasterize(gx, gy)
+        grid[lx, ly] = 1
+
+        # Windows with at least 3 lit squares, counted per pattern
+        # in the order the patterns first appear scanning row by row.
+        codes, marked = pattern_codes(grid)
+        codes = codes[marked >= 3]
+
+        found, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        order = np.argsort(first)
+
+        return {SHAPE_KEYS[found[i]]: [int(counts[i]), "class"] for i in order}
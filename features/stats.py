@@ -1,4 +1,9 @@
+import copy
+import json
 import math
+import zlib
+
+import numpy as np
 
 ############################################################################
 #
@@ -10,12 +15,62 @@ import math
 ############################################################################
 
 
+# Flags derived from a series feature, in get_series order.
+SERIES_SUFFIXES = (
+    "_above_avg",
+    "_above_1sd",
+    "_above_2sd",
+    "_below_1sd",
+    "_below_2sd",
+    "_above_var",
+    "_above_var_1sd",
+    "_above_var_2sd",
+    "_below_var_1sd",
+    "_below_var_2sd",
+)
+
+
+# (label, value, type) of every raw feature of a result, from the
+# result itself where it can (e.g. store backed paths.Result).
+def _feature_items(result):
+
+    if hasattr(result, "feature_items"):
+        return result.feature_items()
+
+    features = result.features
+
+    return (
+        (f, features[t][f][0], features[t][f][1]) for t in features for f in features[t]
+    )
+
+
+# The ResultStore all the results are held in, if they share one,
+# with any results still waiting to be decoded loaded into it.
+def _shared_store(results):
+
+    store = getattr(results[0], "store", None) if len(results) else None
+
+    if store is None or any(getattr(r, "store", None) is not store for r in results):
+        return None
+
+    for result in results:
+        if result.row is None:
+            result.load()
+
+    return store
+
+
 class FeatureStats(object):
 
     # Maintain mappings to be able to calculate
     # average, median, range, std dev, variance
     # for each variable, where applicable.
-    def __init__(self):
+    #
+    # With online=True series features keep running
+    # central moments (count, mean, M2, M3, M4) rather
+    # than every observed value, giving the same stats
+    # in constant memory per feature.
+    def __init__(self, online=True):
 
         # 'label' -> {type:'a',		  // 'bool','series','class'
         # 			  'trueCount':n,  // For boolean variable type
@@ -23,6 +78,8 @@ class FeatureStats(object):
         # 			  '
         self.features = {}
 
+        self.online = online
+
         # Is the stats object valid for normalization?
         self.ready = False
 
@@ -34,18 +91,16 @@ class FeatureStats(object):
         self.ready = False
         try:
 
-            for t in result.features:
-
-                for f in result.features[t]:
-                    if f =='first_movement_delay':
-                        continue
+            for f, value, kind in _feature_items(result):
+                if f =='first_movement_delay':
+                    continue
 
-                    if result.features[t][f][1] == "bool":
-                        self.type_bool(f, result.features[t][f][0])
-                    elif result.features[t][f][1] == "series":
-                        self.type_series(f, result.features[t][f][0])
-                    elif result.features[t][f][1] == "class":
-                        self.type_class(f, result.features[t][f][0])
+                if kind == "bool":
+                    self.type_bool(f, value)
+                elif kind == "series":
+                    self.type_series(f, value)
+                elif kind == "class":
+                    self.type_class(f, value)
 
         except TypeError as err:
             print(err)
@@ -59,18 +114,210 @@ class FeatureStats(object):
             self.prepare_stats()
             self.ready = True
 
-        for t in result.features:
+        # Update result.norm_features with the
+        # set of normalized distributional
+        # features.
+        for f, value, kind in _feature_items(result):
+            if f == 'first_movement_delay':
+                continue
+
+            result.norm_features.update(self.retrieve_features(f, value))
+
+    # Normalise many results at once. Rather than filling a
+    # norm_features dict per result, the flags are laid out
+    # as a results x flags boolean matrix sharing one column
+    # index, with every threshold computed by broadcasting.
+    # labels optionally restricts the raw features covered.
+    def normalize_batch(self, results, labels=None):
+
+        if self.ready == False:
+            self.prepare_stats()
+            self.ready = True
+
+        series, bools, classes = [], [], []
+        for l in self.features:
+            if labels is not None and l not in labels:
+                continue
+            if self.features[l]["type"] == "series":
+                series.append(l)
+            elif self.features[l]["type"] == "bool":
+                bools.append(l)
+            elif self.features[l]["type"] == "class":
+                classes.append(l)
+
+        series_pos = {l: i for i, l in enumerate(series)}
+        bool_pos = {l: i for i, l in enumerate(bools)}
+        class_pos = {l: i for i, l in enumerate(classes)}
+
+        # get_class compares against whichever class the
+        # set happens to yield last, mirror that here.
+        class_last = []
+        class_max = []
+        for l in classes:
+            last = None
+            for c in self.features[l]["classes"]:
+                last = c
+            class_last.append(last)
+            class_max.append(max(self.features[l][c] for c in self.features[l]["classes"]))
+
+        n = len(results)
+        values = np.full((n, len(series)), np.nan)
+        bool_values = np.zeros((n, len(bools)), dtype=bool)
+        bool_present = np.zeros((n, len(bools)), dtype=bool)
+        class_flags = np.zeros((n, 2 * len(classes)), dtype=bool)
+        valid = np.zeros(n, dtype=bool)
+
+        # Results sharing a ResultStore are read straight from its
+        # arrays, any others one feature at a time.
+        store = _shared_store(results)
+        if store is not None:
+            loose = self._gather_store(
+                store, results, series_pos, bool_pos, class_pos, class_last, class_max,
+                values, bool_values, bool_present, class_flags, valid,
+            )
+        else:
+            loose = range(n)
+
+        for i in loose:
+
+            if not results[i].features:
+                continue
 
-            # Update result.norm_features with the
-            # set of normalized distributional
-            # features.
-            for f in result.features[t]:
-                if f == 'first_movement_delay':
+            for f, value, kind in _feature_items(results[i]):
+                if f == "first_movement_delay" or f not in self.features:
                     continue
 
-                result.norm_features.update(
-                    self.retrieve_features(f, result.features[t][f][0])
-                )
+                valid[i] = True
+
+                if f in series_pos:
+                    values[i, series_pos[f]] = value
+
+                elif f in bool_pos:
+                    bool_values[i, bool_pos[f]] = value
+                    bool_present[i, bool_pos[f]] = True
+
+                elif f in class_pos:
+                    j = class_pos[f]
+                    class_flags[i, 2 * j] = value == class_last[j]
+                    class_flags[i, 2 * j + 1] = (
+                        self.features[f].get(value, 0) == class_max[j]
+                    )
+
+        blocks = []
+        columns = []
+
+        if series:
+            avg = np.array([self.features[l]["avg"] for l in series], dtype=float)
+            sdv = np.array([self.features[l]["sdv"] for l in series], dtype=float)
+            var = np.array([self.features[l]["var"] for l in series], dtype=float)
+            vsd = np.array([self.features[l]["vsd"] for l in series], dtype=float)
+
+            # Same order and thresholds as get_series.
+            flags = np.stack(
+                [
+                    values > avg,
+                    values > avg + sdv,
+                    values > avg + 2 * sdv,
+                    values < avg - sdv,
+                    values < avg - 2 * sdv,
+                    values > var,
+                    values > var + vsd,
+                    values > var + 2 * vsd,
+                    values < var - vsd,
+                    values < var - 2 * vsd,
+                ],
+                axis=2,
+            )
+            blocks.append(flags.reshape(n, len(series) * len(SERIES_SUFFIXES)))
+            columns.extend(l + suffix for l in series for suffix in SERIES_SUFFIXES)
+
+        if bools:
+            true_counts = np.array([self.features[l][True] for l in bools])
+            false_counts = np.array([self.features[l][False] for l in bools])
+
+            # As get_bool: the observed value is predominant
+            # when it outnumbers the opposite value.
+            predominant = np.where(
+                bool_values, true_counts > false_counts, false_counts > true_counts
+            )
+            flags = np.stack([bool_values, predominant & bool_present], axis=2)
+            blocks.append(flags.reshape(n, 2 * len(bools)))
+            columns.extend(c for l in bools for c in (l, l + "_predominant"))
+
+        if classes:
+            blocks.append(class_flags)
+            columns.extend(c for l in classes for c in (str(l), str(l) + "_predominant"))
+
+        flags = np.hstack(blocks) if blocks else np.zeros((n, 0), dtype=bool)
+
+        return NormFeatures(flags, columns, valid)
+
+    # Fill the normalize_batch arrays for results backed by one
+    # ResultStore from its entry arrays. Where a result has a label
+    # more than once the last entry counts, as in the loop over its
+    # features. Returns the positions of results kept as raw dicts
+    # in the store, which are left to that loop.
+    def _gather_store(self, store, results, series_pos, bool_pos, class_pos,
+                      class_last, class_max, values, bool_values, bool_present,
+                      class_flags, valid):
+
+        rows = np.array([r.row for r in results], dtype=np.int64)
+        pos, ids, vals = store.entries(rows)
+
+        # Which block and column each feature id lands in.
+        labels = []
+        block = np.zeros(len(store.keys), dtype=np.int64)
+        column = np.zeros(len(store.keys), dtype=np.int64)
+        for k, (family, label, kind, vtype) in enumerate(store.keys):
+            labels.append(label)
+            if kind is None or label == "first_movement_delay" or label not in self.features:
+                continue
+            for b, where in enumerate((series_pos, bool_pos, class_pos), 1):
+                if label in where:
+                    block[k] = b
+                    column[k] = where[label]
+            if block[k] == 0:
+                block[k] = 4
+
+        known = block[ids] > 0
+        pos, ids, vals = pos[known], ids[known], vals[known]
+        valid[pos] = True
+
+        # Keep the last entry per result and label.
+        label_id = {}
+        codes = np.array([label_id.setdefault(l, len(label_id)) for l in labels], dtype=np.int64)
+        key = pos * max(len(label_id), 1) + codes[ids]
+        _, last = np.unique(key[::-1], return_index=True)
+        last = len(key) - 1 - last
+        pos, ids, vals = pos[last], ids[last], vals[last]
+
+        kinds, cols = block[ids], column[ids]
+
+        sel = kinds == 1
+        values[pos[sel], cols[sel]] = vals[sel]
+
+        sel = kinds == 2
+        bool_values[pos[sel], cols[sel]] = vals[sel] != 0
+        bool_present[pos[sel], cols[sel]] = True
+
+        sel = kinds == 3
+        if sel.any():
+            cpos, ccol, cval = pos[sel], cols[sel], vals[sel]
+            pairs, inverse = np.unique(
+                np.column_stack((ccol.astype(float), cval)), axis=0, return_inverse=True
+            )
+            inverse = inverse.reshape(-1)
+            classes = list(class_pos)
+            is_last = np.zeros(len(pairs), dtype=bool)
+            is_max = np.zeros(len(pairs), dtype=bool)
+            for p, (j, value) in enumerate(pairs.tolist()):
+                j = int(j)
+                is_last[p] = value == class_last[j]
+                is_max[p] = self.features[classes[j]].get(value, 0) == class_max[j]
+            class_flags[cpos, 2 * ccol] = is_last[inverse]
+            class_flags[cpos, 2 * ccol + 1] = is_max[inverse]
+
+        return [i for i, row in enumerate(rows.tolist()) if row in store.raw]
 
     ###############################################
     # The following functions manage the building
@@ -93,14 +340,43 @@ class FeatureStats(object):
 
             self.features[label] = {
                 "type": "series",
-                "values": [],
                 "avg": 0,
                 "sdv": 0,
                 "var": 0,
                 "vsd": 0,
             }
 
-        self.features[label]["values"].append(value)
+            if self.online:
+                self.features[label].update(
+                    {"n": 0, "mean": 0.0, "m2": 0.0, "m3": 0.0, "m4": 0.0}
+                )
+            else:
+                self.features[label]["values"] = []
+
+        if "values" in self.features[label]:
+            self.features[label]["values"].append(value)
+            return
+
+        # Single pass update of the central moments, see
+        # Terriberry's extension of Welford's algorithm.
+        stat = self.features[label]
+
+        n1 = stat["n"]
+        n = n1 + 1
+        delta = value - stat["mean"]
+        delta_n = delta / n
+        delta_n2 = delta_n * delta_n
+        term1 = delta * delta_n * n1
+
+        stat["mean"] += delta_n
+        stat["m4"] += (
+            term1 * delta_n2 * (n * n - 3 * n + 3)
+            + 6 * delta_n2 * stat["m2"]
+            - 4 * delta_n * stat["m3"]
+        )
+        stat["m3"] += term1 * delta_n * (n - 2) - 3 * delta_n * stat["m2"]
+        stat["m2"] += term1
+        stat["n"] = n
 
     # Calculate specific class info
     def type_class(self, label, value):
@@ -122,7 +398,24 @@ class FeatureStats(object):
 
         for l in self.features:
 
-            if self.features[l]["type"] == "series":
+            if self.features[l]["type"] == "series" and "values" not in self.features[l]:
+
+                stat = self.features[l]
+
+                if stat["n"] == 1:
+                    continue
+
+                # The deviations (x - avg)^2 have mean M2/n and
+                # sum of squared deviations M4 - M2^2/n.
+                var = stat["m2"] / (stat["n"] - 1)
+                vsd = (stat["m4"] - stat["m2"] * stat["m2"] / stat["n"]) / (stat["n"] - 1)
+
+                stat["avg"] = stat["mean"]
+                stat["var"] = var
+                stat["sdv"] = math.sqrt(var)
+                stat["vsd"] = math.sqrt(max(vsd, 0.0))
+
+            elif self.features[l]["type"] == "series":
 
                 avg = sum(self.features[l]["values"]) / len(self.features[l]["values"])
 
@@ -162,6 +455,236 @@ class FeatureStats(object):
                 self.features[l]["sdv"] = sdv
                 self.features[l]["vsd"] = vsd
 
+        self.ready = True
+
+    ###############################################
+    # Persistence, so the stats of one run can be
+    # carried into the next (incremental) run.
+    ###############################################
+
+    # A JSON-serialisable copy of the raw (pre-aggregate) stats.
+    def to_dict(self):
+
+        features = {}
+
+        for l in self.features:
+
+            if self.features[l]["type"] == "bool":
+                features[l] = {
+                    "type": "bool",
+                    "true": self.features[l][True],
+                    "false": self.features[l][False],
+                }
+
+            elif "values" in self.features[l]:
+                features[l] = {"type": "series", "values": self.features[l]["values"]}
+
+            elif self.features[l]["type"] == "series":
+                features[l] = {"type": "series"}
+                for m in ("n", "mean", "m2", "m3", "m4"):
+                    features[l][m] = self.features[l][m]
+
+            elif self.features[l]["type"] == "class":
+                # Class values are not necessarily strings, so keep
+                # them as pairs rather than as JSON object keys.
+                features[l] = {
+                    "type": "class",
+                    "counts": [[c, self.features[l][c]] for c in self.features[l]["classes"]],
+                }
+
+        return {"online": self.online, "features": features}
+
+    @classmethod
+    def from_dict(cls, data):
+
+        fs = cls(online=data.get("online", True))
+
+        for l, stat in data["features"].items():
+
+            if stat["type"] == "bool":
+                fs.features[l] = {"type": "bool", True: stat["true"], False: stat["false"]}
+
+            elif stat["type"] == "series":
+                fs.features[l] = {
+                    "type": "series",
+                    "avg": 0,
+                    "sdv": 0,
+                    "var": 0,
+                    "vsd": 0,
+                }
+                if "values" in stat:
+                    fs.features[l]["values"] = list(stat["values"])
+                else:
+                    for m in ("n", "mean", "m2", "m3", "m4"):
+                        fs.features[l][m] = stat[m]
+
+            elif stat["type"] == "class":
+                fs.features[l] = {"type": "class", "classes": set()}
+                for c, n in stat["counts"]:
+                    fs.features[l][c] = n
+                    fs.features[l]["classes"].add(c)
+
+        return fs
+
+    # Compact binary form of to_dict, for passing partial
+    # stats between processes or invocations.
+    def to_bytes(self):
+
+        return zlib.compress(
+            json.dumps(self.to_dict(), separators=(",", ":")).encode("utf-8")
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+
+        return cls.from_dict(json.loads(zlib.decompress(data).decode("utf-8")))
+
+    ###############################################
+    # Combining stats built over separate shards
+    # of the results.
+    ###############################################
+
+    # Fold the observations of another stats object into this
+    # one, as if its results had been added here. Returns self.
+    def merge(self, other):
+
+        self.ready = False
+
+        for l in other.features:
+
+            theirs = other.features[l]
+
+            if l not in self.features:
+                self.features[l] = copy.deepcopy(theirs)
+                continue
+
+            mine = self.features[l]
+
+            if mine["type"] != theirs["type"]:
+                raise ValueError(
+                    f"Cannot merge '{l}': {mine['type']} and {theirs['type']}"
+                )
+
+            if mine["type"] == "bool":
+                mine[True] += theirs[True]
+                mine[False] += theirs[False]
+
+            elif mine["type"] == "class":
+                for c in theirs["classes"]:
+                    if c not in mine["classes"]:
+                        mine[c] = 0
+                        mine["classes"].add(c)
+                    mine[c] += theirs[c]
+
+            elif "values" in mine and "values" in theirs:
+                mine["values"].extend(theirs["values"])
+
+            else:
+                self._merge_moments(mine, theirs)
+
+        return self
+
+    # Reduce a sequence of partial stats into a new object.
+    @classmethod
+    def combine(cls, parts):
+
+        fs = cls()
+
+        for part in parts:
+            fs.merge(part)
+
+        return fs
+
+    # Pairwise combination of central moments, see Pebay (2008).
+    def _merge_moments(self, mine, theirs):
+
+        na, ma, m2a, m3a, m4a = self._moments(mine)
+        nb, mb, m2b, m3b, m4b = self._moments(theirs)
+
+        n = na + nb
+        delta = mb - ma
+        delta2 = delta * delta
+
+        mine.pop("values", None)
+        mine["n"] = n
+        mine["mean"] = ma + delta * nb / n
+        mine["m4"] = (
+            m4a
+            + m4b
+            + delta2 * delta2 * na * nb * (na * na - na * nb + nb * nb) / (n * n * n)
+            + 6 * delta2 * (na * na * m2b + nb * nb * m2a) / (n * n)
+            + 4 * delta * (na * m3b - nb * m3a) / n
+        )
+        mine["m3"] = (
+            m3a
+            + m3b
+            + delta2 * delta * na * nb * (na - nb) / (n * n)
+            + 3 * delta * (na * m2b - nb * m2a) / n
+        )
+        mine["m2"] = m2a + m2b + delta2 * na * nb / n
+
+    # Central moments of a series entry in either representation.
+    def _moments(self, stat):
+
+        if "values" not in stat:
+            return stat["n"], stat["mean"], stat["m2"], stat["m3"], stat["m4"]
+
+        fs = FeatureStats(online=True)
+        for value in stat["values"]:
+            fs.type_series("x", value)
+
+        return self._moments(fs.features["x"])
+
+    # The largest change between the normalisation thresholds of
+    # this (prepared) stats object and another. Series thresholds
+    # are measured in standard deviations of this object; a flip
+    # of a predominant bool or class counts as infinite. Labels
+    # only present in the other object do not count, as results
+    # already normalised against this object never had them.
+    # labels optionally restricts the comparison.
+    def max_shift(self, other, labels=None):
+
+        shift = 0.0
+
+        for l in self.features:
+
+            if l not in other.features or (labels is not None and l not in labels):
+                continue
+
+            mine = self.features[l]
+            theirs = other.features[l]
+
+            if mine["type"] == "series":
+                for centre, spread in (("avg", "sdv"), ("var", "vsd")):
+                    delta = max(
+                        abs(mine[centre] - theirs[centre]),
+                        abs(mine[spread] - theirs[spread]),
+                    )
+                    if not delta:
+                        continue
+                    if not mine[spread]:
+                        return math.inf
+                    shift = max(shift, delta / mine[spread])
+
+            elif mine["type"] == "bool":
+                if (mine[True] > mine[False]) != (theirs[True] > theirs[False]) or (
+                    mine[False] > mine[True]
+                ) != (theirs[False] > theirs[True]):
+                    return math.inf
+
+            elif mine["type"] == "class":
+                if self._predominant(mine) != self._predominant(theirs):
+                    return math.inf
+
+        return shift
+
+    @staticmethod
+    def _predominant(stat):
+
+        maxi = max(stat[c] for c in stat["classes"])
+
+        return {c for c in stat["classes"] if stat[c] == maxi}
+
     ###############################################
     # Convert raw features into normalized
     # relative features.
@@ -235,3 +758,49 @@ class FeatureStats(object):
             features[str(label) + "_predominant"] = False
 
         return features
+
+
+############################################################################
+#
+# NormFeatures holds the normalised features of many results as a
+# boolean matrix, one row per result and one column per flag, with a
+# shared mapping of flag names to columns. A flag a result does not
+# have is simply False.
+#
+############################################################################
+
+
+class NormFeatures(object):
+
+    def __init__(self, flags, columns, valid):
+
+        # results x flags boolean matrix
+        self.flags = flags
+
+        # flag name per column, and the reverse mapping
+        self.columns = list(columns)
+        self.index = {c: i for i, c in enumerate(self.columns)}
+
+        # Rows that had any features to normalise; the
+        # others would have an empty norm_features dict.
+        self.valid = valid
+
+    def __len__(self):
+
+        return self.flags.shape[0]
+
+    # Boolean vector of one flag across all results.
+    def column(self, name):
+
+        if name not in self.index:
+            return np.zeros(len(self), dtype=bool)
+
+        return self.flags[:, self.index[name]]
+
+    # The flags of a single result as a norm_features style dict.
+    def row(self, i):
+
+        if not self.valid[i]:
+            return {}
+
+        return {c: bool(v) for c, v in zip(self.columns, self.flags[i])}
@@ -1 +1,2 @@
 from geometry.geometry import *
+from geometry.batch import *
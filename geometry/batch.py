@@ -0,0 +1,188 @@
+import math
+
+import numpy as np
+
+##############################################################################
+#
+# Batch versions of the path normalisation functions, for many raw paths
+# at once. Paths are held as a ragged array: every point of every path
+# in one flat (m,3) float array, with offsets marking where each path
+# starts, so path i is coords[offsets[i]:offsets[i + 1]].
+#
+# Raw paths are (time,x,y) points as for bipartiteNormPath; normalised
+# paths are (x,y,time) points. Each normalised path is exactly what the
+# single path function returns for it.
+#
+##############################################################################
+
+
+class PathBatch(object):
+
+    def __init__(self, coords, offsets):
+
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        if len(self.offsets) == 0 or self.offsets[-1] != len(self.coords):
+            raise ValueError("Offsets must end at the number of points.")
+
+    @classmethod
+    def fromPaths(cls, paths):
+
+        lengths = [len(p) for p in paths]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        coords = [point[:3] for p in paths for point in p]
+
+        return cls(np.array(coords, dtype=float).reshape(-1, 3), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # Path i as a list of points.
+    def path(self, i):
+        return self.coords[self.offsets[i] : self.offsets[i + 1]].tolist()
+
+    def paths(self):
+        return [self.path(i) for i in range(len(self))]
+
+
+# Rotate points around an origin per point, as rotatePoint does,
+# with the cosine and sine worked out once.
+def rotatePoints(x, y, offset_x, offset_y, degrees):
+
+    radians = degrees * math.pi / 180
+
+    adjusted_x = x - offset_x
+    adjusted_y = y - offset_y
+    cos_rad = math.cos(radians)
+    sin_rad = math.sin(radians)
+    qx = offset_x + cos_rad * adjusted_x + sin_rad * adjusted_y
+    qy = offset_y + -sin_rad * adjusted_x + cos_rad * adjusted_y
+
+    return qx, qy
+
+
+# bipartiteNormPath for every path of a PathBatch of raw paths.
+#
+# Returns the normalised PathBatch and a dict of path index to the
+# ValueError for paths whose answers are stacked. Those paths, and
+# paths of fewer than two points, are left empty.
+def bipartiteNormPaths(batch):
+
+    lengths = batch.lengths()
+    ok = lengths >= 2
+
+    if not ok.any():
+        return PathBatch(np.empty((0, 3)), np.zeros(len(batch) + 1)), {}
+
+    # Index of the first and last point of every path.
+    first = batch.offsets[:-1]
+    last = batch.offsets[1:] - 1
+
+    seg = np.repeat(np.arange(len(batch)), lengths)
+    keep = ok[seg]
+
+    t, x, y = batch.coords[:, 0], batch.coords[:, 1], batch.coords[:, 2]
+
+    # Times run from the first non-zero time of the path; points
+    # before it are at 0.
+    index = np.arange(len(t))
+    nonzero = np.where(t != 0, index, len(t))
+    start = np.full(len(batch), len(t))
+    filled = lengths > 0
+    start[filled] = np.minimum.reduceat(nonzero, first[filled])
+    after = index >= start[seg]
+    t = t - np.where(after, t[np.minimum(start, len(t) - 1)][seg], t)
+
+    # Flip coordinate system around y-midpoint of first and last point.
+    plane = np.zeros(len(batch))
+    plane[ok] = (y[first[ok]] - y[last[ok]]) / 2 + y[last[ok]]
+    dist = np.abs(y - plane[seg])
+    y = np.where(y > plane[seg], y - 2 * dist, y + 2 * dist)
+
+    offset_x = np.zeros(len(batch))
+    offset_y = np.zeros(len(batch))
+    scale_x = np.zeros(len(batch))
+    scale_y = np.zeros(len(batch))
+    reverse = np.zeros(len(batch), dtype=bool)
+
+    offset_x[ok] = x[first[ok]]
+    offset_y[ok] = y[first[ok]]
+    scale_x[ok] = np.abs(x[first[ok]] - x[last[ok]])
+    scale_y[ok] = np.abs(y[first[ok]] - y[last[ok]])
+    reverse[ok] = x[last[ok]] < x[first[ok]]
+
+    # Do not allow rendering of options
+    # in a stacked manner or side-by-side.
+    stacked = ok & ((scale_x == 0) | (scale_y == 0))
+    errors = {
+        int(i): ValueError("Invalid layout detected: answers stacked.")
+        for i in np.flatnonzero(stacked)
+    }
+    keep &= ~stacked[seg]
+
+    seg = seg[keep]
+    x = (x[keep] - offset_x[seg]) / scale_x[seg]
+    y = (y[keep] - offset_y[seg]) / scale_y[seg]
+    x = np.where(reverse[seg], x * -1, x)
+
+    kept = np.where(ok & ~stacked, lengths, 0)
+    offsets = np.concatenate(([0], np.cumsum(kept)))
+
+    return PathBatch(np.column_stack((x, y, t[keep])), offsets), errors
+
+
+# tripartiteNormPath for every path of a PathBatch of raw paths, given
+# the options and response of each. Paths answered with the middle
+# option ('option1') are rotated 45 degrees clockwise around their
+# first point, then all are normalised as bipartite.
+#
+# Returns as bipartiteNormPaths, with the error tripartiteNormPath
+# would raise for a path reported for it as well: a ValueError for
+# questions without three options, a KeyError for a response that is
+# not one of them and a TypeError for options that are not a mapping.
+# Unlike tripartiteNormPath, no midpoints are taken or updated.
+def tripartiteNormPaths(batch, options, responses):
+
+    if len(options) != len(batch) or len(responses) != len(batch):
+        raise ValueError("Expected options and a response for every path.")
+
+    errors = {}
+    rotate = np.zeros(len(batch), dtype=bool)
+
+    for i, (opts, response) in enumerate(zip(options, responses)):
+        try:
+            if len(opts) != 3:
+                raise ValueError("Incorrect number of options for a tripartite question.")
+            rotate[i] = opts[response] == "option1"
+        except (KeyError, TypeError, ValueError) as err:
+            errors[i] = err
+
+    lengths = batch.lengths()
+    seg = np.repeat(np.arange(len(batch)), lengths)
+    turn = rotate[seg]
+
+    coords = batch.coords.copy()
+    if turn.any():
+        first = batch.offsets[:-1][seg[turn]]
+        qx, qy = rotatePoints(
+            coords[turn, 1], coords[turn, 2], coords[first, 1], coords[first, 2], 45
+        )
+        coords[turn, 1] = qx
+        coords[turn, 2] = qy
+
+    # Paths with the wrong options are not normalised.
+    if errors:
+        invalid = np.zeros(len(batch), dtype=bool)
+        invalid[list(errors)] = True
+        keep = ~invalid[seg]
+        kept = np.where(invalid, 0, lengths)
+        offsets = np.concatenate(([0], np.cumsum(kept)))
+        norm, stacked = bipartiteNormPaths(PathBatch(coords[keep], offsets))
+        errors.update(stacked)
+        return norm, errors
+
+    return bipartiteNormPaths(PathBatch(coords, batch.offsets))
@@ -0,0 +1,212 @@
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import os
+import threading
+import time
+import uuid
+
+from logger import get_logger
+from metrics import RunMetrics
+from profiling import profiling
+
+logger = get_logger('process.jobs')
+
+# Most processing jobs run at once, and how many finished jobs are
+# remembered for the status endpoint.
+MAX_JOBS = int(os.environ.get("PROCESS_MAX_JOBS", 2))
+JOB_HISTORY = int(os.environ.get("PROCESS_JOB_HISTORY", 100))
+
+# Profile every job, not only those asked for (see profiling.py).
+PROFILE_JOBS = os.environ.get("PROCESS_PROFILE_JOBS", "0") == "1"
+
+
+##############################################################################
+#
+# Job scheduling for the processing service. Requests for a survey
+# version become jobs run by a pool of worker threads, so the event
+# loop never runs the pipeline itself.
+#
+# At most one job per survey version runs at a time. Requests made
+# while one is running queue a single follow-up job, and requests made
+# while that one waits are folded into it, so repeated requests cost
+# at most one extra run. A follow-up runs in full if any request folded
+# into it asked for a full run, and is profiled if any of them asked
+# for a profile.
+#
+##############################################################################
+
+
+def _timestamp(seconds):
+    if seconds is None:
+        return None
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+
+class Job(object):
+
+    def __init__(self, survey_version, incremental=False, profile=False):
+
+        self.id = uuid.uuid4().hex
+        self.survey_version = survey_version
+        self.incremental = incremental
+
+        # Whether to profile the job, and the files written if so.
+        self.profile = profile
+        self.profile_files = None
+
+        # queued -> running -> done | failed
+        self.status = "queued"
+        self.error = None
+        self.requests = 1
+
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+        # [stage, start, end] of every stage reported so far, and
+        # the metrics of the stages finished.
+        self.stages = []
+        self.metrics = RunMetrics()
+
+        self._done = threading.Event()
+
+    # Progress callback for process(): a stage has started.
+    def progress(self, stage):
+
+        now = time.time()
+        if self.stages:
+            self.stages[-1][2] = now
+        self.stages.append([stage, now, None])
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+
+        now = time.time()
+        started = self.started or now
+        finished = self.finished or now
+
+        return {
+            "id": self.id,
+            "survey_version": self.survey_version,
+            "incremental": self.incremental,
+            "status": self.status,
+            "stage": self.stages[-1][0] if self.stages else None,
+            "requests": self.requests,
+            "error": self.error,
+            "submitted": _timestamp(self.submitted),
+            "started": _timestamp(self.started),
+            "finished": _timestamp(self.finished),
+            "queued_seconds": started - self.submitted,
+            "run_seconds": finished - started if self.started else None,
+            "stages": [
+                {"stage": stage, "seconds": (end or finished) - start}
+                for stage, start, end in self.stages
+            ],
+            "metrics": list(self.metrics.stages),
+            "profile": self.profile_files,
+        }
+
+
+class JobScheduler(object):
+
+    def __init__(self, run, max_jobs=MAX_JOBS, history=JOB_HISTORY):
+
+        # run(survey_version, incremental=..., progress=..., metrics=...)
+        # does the work.
+        self.run = run
+        self.history = history
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_jobs, thread_name_prefix="job"
+        )
+
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+
+        # survey version -> job submitted to the pool, and the job
+        # waiting for it to finish.
+        self.active = {}
+        self.pending = {}
+
+    # Schedule processing of a survey version, returning its job.
+    def submit(self, survey_version, incremental=False, profile=False):
+
+        profile = profile or PROFILE_JOBS
+
+        with self.lock:
+            job = self.pending.get(survey_version)
+            if job is not None:
+                job.requests += 1
+                job.incremental = job.incremental and incremental
+                job.profile = job.profile or profile
+                return job
+
+            job = Job(survey_version, incremental, profile)
+            self.jobs[job.id] = job
+
+            if survey_version in self.active:
+                self.pending[survey_version] = job
+            else:
+                self._start(job)
+
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    # Called with the lock held.
+    def _start(self, job):
+        self.active[job.survey_version] = job
+        self.executor.submit(self._execute, job)
+
+    def _execute(self, job):
+
+        job.started = time.time()
+        job.status = "running"
+        logger.info(f"Job {job.id} started for survey: {job.survey_version}")
+
+        profiler = (
+            profiling(f"survey{job.survey_version}-{job.id}")
+            if job.profile
+            else contextlib.nullcontext()
+        )
+
+        try:
+            with profiler as files:
+                job.profile_files = files
+                self.run(job.survey_version, incremental=job.incremental,
+                         progress=job.progress, metrics=job.metrics)
+        except Exception as err:
+            job.status = "failed"
+            job.error = repr(err)
+            logger.exception(f"Job {job.id} failed for survey: {job.survey_version}")
+        else:
+            job.status = "done"
+            logger.info(f"Job {job.id} done for survey: {job.survey_version}")
+        finally:
+            job.finished = time.time()
+            if job.stages:
+                job.stages[-1][2] = job.finished
+            job._done.set()
+
+            with self.lock:
+                del self.active[job.survey_version]
+                waiting = self.pending.pop(job.survey_version, None)
+                if waiting is not None:
+                    self._start(waiting)
+                self._forget()
+
+    # Drop the oldest finished jobs beyond the history kept.
+    # Called with the lock held.
+    def _forget(self):
+
+        finished = [j for j in self.jobs.values() if j.finished is not None]
+        for job in finished[: max(0, len(finished) - self.history)]:
+            del self.jobs[job.id]
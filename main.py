@@ -1,9 +1,16 @@
-from fastapi import BackgroundTasks, FastAPI
+import os
+
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from process import process
+from jobs import JobScheduler
 from mangum import Mangum
 
 app = FastAPI()
 
+# Processing runs on the scheduler's worker threads, one job per
+# survey version at a time.
+scheduler = JobScheduler(process)
+
 
 #@app.get("/")
 #async def start_processing(survey_version: int, background_tasks: BackgroundTasks):
@@ -11,10 +18,26 @@ app = FastAPI()
 #   return {"message": "Welcome to FFML"}
 
 
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
 @app.get("/{survey_version}")
-async def start_processing(survey_version: int, background_tasks: BackgroundTasks):
-    background_tasks.add_task(process, survey_version)
-    return {"message": "Processing started in background"}
+async def start_processing(survey_version: int, background_tasks: BackgroundTasks,
+                           incremental: bool = False, profile: bool = False):
+    job = scheduler.submit(survey_version, incremental=incremental, profile=profile)
+
+    # Lambda freezes once the response is sent, so there the invocation
+    # is held open until the job is done, as background tasks were.
+    if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+        background_tasks.add_task(job.wait)
+
+    return {"message": "Processing started in background", "job_id": job.id,
+            "status": job.status}
 
 # Add Mangum adapter to make FastAPI compatible with AWS Lambda
 handler = Mangum(app)
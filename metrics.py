@@ -0,0 +1,157 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+##############################################################################
+#
+# RunMetrics records where the time of a processing run goes: the wall
+# time, CPU time, rows and resident memory of every stage.
+#
+# CPU time is that of the thread running the stage, so jobs running in
+# other threads of the same process are not counted. Stages run in
+# worker processes report the CPU time the workers measured themselves.
+#
+# Memory is the RSS of the process when the stage ended, how much it
+# grew over the stage and its peak over the stage. The peak is read from
+# VmHWM, which every stage resets through /proc/self/clear_refs when it
+# starts; it is None where that is not allowed, or when another stage
+# (of another run) reset it in the meantime. RSS is shared by every
+# thread, so all three include the memory of any job running alongside.
+# A stage recorded with add() gets the peak since the last start(). The
+# process peak RSS in to_dict() is the highest since the process
+# started, not of this run.
+#
+# progress, if given, is called with the name of every stage as it
+# starts.
+#
+##############################################################################
+
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# Current RSS of the process in MiB, or None where /proc is not there.
+def rss_mib():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Number of peak RSS resets so far, so a stage can tell whether the
+# peak was reset again after its own reset, and the highest peak
+# cleared by them, as resets clear ru_maxrss as well.
+_peak_resets = 0
+_peak_cleared = 0.0
+_peak_lock = threading.Lock()
+
+
+# Reset the peak RSS of the process to its current RSS, returning the
+# number of resets so far, or None where the kernel does not allow it.
+def reset_peak_rss():
+
+    global _peak_resets, _peak_cleared
+
+    with _peak_lock:
+        _peak_cleared = max(_peak_cleared, peak_rss_mib() or 0.0)
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            return None
+
+        _peak_resets += 1
+        return _peak_resets
+
+
+# Peak RSS since the last reset (or the start of the process) in MiB,
+# or None where /proc is not there.
+def peak_rss_mib():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return None
+
+
+# Peak RSS of the process since it started, in MiB (ru_maxrss is in
+# KiB on Linux).
+def process_peak_rss_mib():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               _peak_cleared, peak_rss_mib() or 0.0)
+
+
+class RunMetrics(object):
+
+    def __init__(self, progress=None):
+
+        self.progress = progress
+        self.stages = []
+        self.started = time.perf_counter()
+
+        # Reset count of the last start(), None once used.
+        self._peak_reset = None
+
+    # Report that a stage has started.
+    def start(self, name):
+        self._peak_reset = reset_peak_rss()
+        if self.progress is not None:
+            self.progress(name)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0):
+
+        self.start(name)
+
+        record = {"stage": name, "rows": rows}
+        rss = rss_mib()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield record
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu,
+                     record["rows"], rss_start_mib=rss,
+                     **{k: v for k, v in record.items() if k not in ("stage", "rows")})
+
+    # Record a stage timed elsewhere, e.g. in worker processes.
+    # rss_start_mib, if given, is the RSS when the stage started.
+    def add(self, name, wall, cpu, rows=0, rss_start_mib=None, **extra):
+
+        rss = rss_mib()
+
+        peak = None
+        with _peak_lock:
+            if self._peak_reset is not None and self._peak_reset == _peak_resets:
+                peak = peak_rss_mib()
+        self._peak_reset = None
+
+        record = {"stage": name, "rows": rows, "wall": wall, "cpu": cpu,
+                  "rss_mib": rss,
+                  "rss_growth_mib": None if rss is None or rss_start_mib is None
+                  else rss - rss_start_mib,
+                  "peak_rss_mib": peak}
+        record.update(extra)
+        self.stages.append(record)
+
+        return record
+
+    def to_dict(self):
+
+        return {
+            "wall": time.perf_counter() - self.started,
+            "rss_mib": rss_mib(),
+            "process_peak_rss_mib": process_peak_rss_mib(),
+            "stages": self.stages,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
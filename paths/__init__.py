@@ -1,2 +1,3 @@
 from paths.paths import *
+from paths.store import *
 from paths.evil import *
@@ -1,5 +1,6 @@
 import features as feats
 import geometry as geo
+from paths.store import feature_items
 
 from ua_parser import user_agent_parser
 
@@ -33,8 +34,30 @@ def get_data(path):
 # Result is a class to describe a single survey question
 # preprocessed with the extracted features.
 #
+# Results are slotted records. Given a ResultStore, the raw features
+# are kept in the store rather than on the result, and only built as
+# a dict when the features attribute is read. Given a decoder (e.g. a
+# FeatureDecoder), features is the undecoded JSON, which is decoded
+# the first time the features are used.
+#
 ##############################################################################
 class Result(object):
+
+    __slots__ = (
+        "unique_id",
+        "participant",
+        "question_type",
+        "question_stimulus",
+        "response",
+        "qlabel",
+        "store",
+        "row",
+        "_features",
+        "_norm_features",
+        "_raw",
+        "decoder",
+    )
+
     def __init__(
         self,
         unique_id,
@@ -44,16 +67,106 @@ class Result(object):
         question_stimulus,
         response,
         qlabel,
+        store=None,
+        decoder=None,
     ):
         self.unique_id = unique_id
         self.participant: str = participant
-        self.features = features
-        self.norm_features = {}
         self.question_type = question_type
         self.question_stimulus = question_stimulus
         self.response = response
         self.qlabel = qlabel
 
+        self.store = store
+        self.row = None
+        self._features = None
+        self.decoder = decoder
+        self._raw = None
+
+        if decoder is not None:
+            self._raw = features
+        elif store is None:
+            self._features = features
+        else:
+            self.row = store.add(features)
+
+        # Only allocated once something is normalised into it.
+        self._norm_features = None
+
+    # Decode features still held as JSON.
+    def load(self):
+
+        if self.decoder is None:
+            return
+
+        features = self.decoder(self._raw)
+        self.decoder = None
+        self._raw = None
+
+        if self.store is None:
+            self._features = features
+        else:
+            self.row = self.store.add(features)
+
+    @property
+    def features(self):
+
+        self.load()
+
+        if self.store is None:
+            return self._features
+
+        return self.store.features(self.row)
+
+    @features.setter
+    def features(self, features):
+
+        self.store = None
+        self.row = None
+        self.decoder = None
+        self._raw = None
+        self._features = features
+
+    @property
+    def norm_features(self):
+
+        if self._norm_features is None:
+            self._norm_features = {}
+
+        return self._norm_features
+
+    @norm_features.setter
+    def norm_features(self, norm_features):
+
+        self._norm_features = norm_features
+
+    # (label, value, type) of every raw feature, in order.
+    def feature_items(self):
+
+        self.load()
+
+        if self.store is None:
+            return feature_items(self._features)
+
+        return self.store.items(self.row)
+
+    # Results travel (e.g. to worker processes) with their features
+    # inline rather than with the whole store.
+    def __reduce__(self):
+
+        return (
+            Result,
+            (
+                self.unique_id,
+                self.participant,
+                self.features,
+                self.question_type,
+                self.question_stimulus,
+                self.response,
+                self.qlabel,
+            ),
+        )
+
 
 ##############################################################################
 #
@@ -0,0 +1,205 @@
+import array
+import json
+
+import numpy as np
+
+# orjson is optional; it only makes decoding faster.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+##############################################################################
+#
+# ResultStore holds the raw features of every result of a survey version
+# column-wise, instead of a dict of dicts of [value, type] lists per
+# result. Every (family, label, type) seen gets an id in a shared index,
+# and each result is a row of (feature id, value) entries in typed
+# arrays, laid out one row after another.
+#
+# Results whose features do not fit that layout (values other than
+# bools and numbers, malformed entries) are kept as given.
+#
+##############################################################################
+
+
+# Python type of each stored value, so values come back as they went in.
+VALUE_TYPES = {bool: "b", int: "i", float: "f"}
+CONVERT = {"b": bool, "i": int, "f": float}
+
+# Integers beyond this do not survive the round trip through a double.
+MAX_EXACT_INT = 2 ** 53
+
+
+# (label, value, type) of every feature in a dict of dicts of
+# [value, type] lists, in order.
+def feature_items(features):
+
+    for t in features:
+        for f in features[t]:
+            yield f, features[t][f][0], features[t][f][1]
+
+
+class ResultStore(object):
+
+    def __init__(self):
+
+        # (family, label, type, value type) -> feature id, and back.
+        # Families without features have a key of (family, None,
+        # None, None) so they are not lost.
+        self.index = {}
+        self.keys = []
+
+        # Entries of row r are offsets[r]:offsets[r + 1].
+        self.offsets = array.array("q", [0])
+        self.ids = array.array("I")
+        self.values = array.array("d")
+
+        # row -> features of rows kept as given.
+        self.raw = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Add the features of a result, returning its row.
+    def add(self, features):
+
+        row = len(self)
+        entries = self._entries(features)
+
+        if entries is None:
+            self.raw[row] = features
+        else:
+            for key, value in entries:
+                fid = self.index.get(key)
+                if fid is None:
+                    fid = self.index[key] = len(self.keys)
+                    self.keys.append(key)
+                self.ids.append(fid)
+                self.values.append(value)
+
+        self.offsets.append(len(self.ids))
+
+        return row
+
+    # (key, value) of every feature, or None if the features
+    # cannot be stored as entries.
+    @staticmethod
+    def _entries(features):
+
+        if not isinstance(features, dict):
+            return None
+
+        entries = []
+        for family, group in features.items():
+
+            if not isinstance(group, dict):
+                return None
+
+            if not group:
+                entries.append(((family, None, None, None), 0.0))
+
+            for label, pair in group.items():
+
+                if not isinstance(pair, list) or len(pair) != 2:
+                    return None
+
+                value, kind = pair
+                vtype = VALUE_TYPES.get(type(value))
+                if vtype is None or not isinstance(kind, str):
+                    return None
+                if vtype == "i" and abs(value) > MAX_EXACT_INT:
+                    return None
+
+                entries.append(((family, label, kind, vtype), float(value)))
+
+        return entries
+
+    # The features of a row as the dict of dicts they were added as.
+    def features(self, row):
+
+        if row in self.raw:
+            return self.raw[row]
+
+        features = {}
+        for i in range(self.offsets[row], self.offsets[row + 1]):
+            family, label, kind, vtype = self.keys[self.ids[i]]
+            group = features.setdefault(family, {})
+            if kind is not None:
+                group[label] = [CONVERT[vtype](self.values[i]), kind]
+
+        return features
+
+    # (label, value, type) of every feature of a row, in order,
+    # without building its dicts.
+    def items(self, row):
+
+        if row in self.raw:
+            yield from feature_items(self.raw[row])
+            return
+
+        keys, ids, values = self.keys, self.ids, self.values
+        for i in range(self.offsets[row], self.offsets[row + 1]):
+            family, label, kind, vtype = keys[ids[i]]
+            if kind is not None:
+                yield label, CONVERT[vtype](values[i]), kind
+
+    # The entries of many rows as arrays: the position of each
+    # entry's row in rows, its feature id and its value. Rows kept
+    # as given have no entries.
+    def entries(self, rows):
+
+        rows = np.asarray(rows, dtype=np.int64)
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+
+        starts = offsets[rows]
+        counts = offsets[rows + 1] - starts
+        pos = np.repeat(np.arange(len(rows)), counts)
+        idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + starts[pos]
+
+        ids = np.frombuffer(self.ids, dtype=np.uint32)[idx].astype(np.int64)
+        values = np.frombuffer(self.values, dtype=float)[idx]
+
+        return pos, ids, values
+
+
+##############################################################################
+#
+# FeatureDecoder turns the features JSON stored with each result into
+# the dict of dicts of [value, type] lists. Given labels, only those
+# features are kept, which drops e.g. the many shape patterns when
+# only the model's features are needed.
+#
+##############################################################################
+
+
+class FeatureDecoder(object):
+
+    def __init__(self, labels=None):
+
+        self.labels = None if labels is None else frozenset(labels)
+
+    def loads(self, raw):
+
+        if orjson is not None and isinstance(raw, (str, bytes)):
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # e.g. NaN, which json accepts and orjson does not.
+                pass
+
+        return json.loads(raw)
+
+    def __call__(self, raw):
+
+        features = self.loads(raw)
+
+        if self.labels is None or not isinstance(features, dict):
+            return features
+
+        return {
+            t: {f: v for f, v in group.items() if f in self.labels}
+            if isinstance(group, dict)
+            else group
+            for t, group in features.items()
+        }
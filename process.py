@@ -1,12 +1,25 @@
 import os
-
+import atexit
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import multiprocessing
+import tempfile
+import threading
+import time
+
+import math
 import statistics
+import numpy as np
 import pandas as pd
 import paths as paths
 import features as features
 import rb_models as models
 
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 
 import json
 import datetime
@@ -14,7 +27,9 @@ import logging
 import csv
 from dotenv import load_dotenv
 from logger import get_logger
+from metrics import RunMetrics
 from st import make_st
+from stats_cache import StatsCache
 
 load_dotenv()
 logger = get_logger('process.process')
@@ -46,96 +61,215 @@ import watchtower
 # Add the handler to the logger
 #logger.addHandler(cloudwatch_handler)
 
-def read_database(cur, survey_version):
-    results = []
-    cur.execute(
-        f"""
-        select * from results 
-        where survey_version_id = {survey_version}
-        """
+# Number of rows pulled from the server-side cursor per round trip
+# when streaming results.
+READ_BATCH_SIZE = int(os.environ.get("PROCESS_READ_BATCH_SIZE", 2000))
+
+
+# How the features JSON of each row is decoded:
+#   eager     - as the row is read
+#   lazy      - the first time the result's features are used
+#   projected - as lazy, keeping only the features the model uses,
+#               and rows of non-choice questions are never decoded
+# Projected drops features from the stats that scoring never reads.
+FEATURE_LOADING = os.environ.get("PROCESS_FEATURE_LOADING", "lazy")
+
+
+def feature_decoder(model, loading=FEATURE_LOADING):
+    if loading == "eager":
+        return None
+    if loading == "lazy":
+        return paths.FeatureDecoder()
+    if loading == "projected":
+        return paths.FeatureDecoder(model.labels())
+    raise ValueError(f"Unknown feature loading mode: {loading}")
+
+
+# Columns of results read for each paths.Result, in the positions
+# _result_from_row takes them from (those of `select *`), so the
+# rest of the row never leaves the server. id is the key watermarks
+# are kept on, and survey_session_chunk_id the unique id of a result
+# written to processed_results.
+RESULT_COLUMNS = [
+    "id",
+    "survey_session_chunk_id",
+    "participant",
+    "question_type",
+    "question_stimulus",
+    "response",
+    "features",
+    "survey_version_id",
+    "qlabel",
+]
+
+# Answers to the device question.
+MOBILE_RESPONSE = "Phone/Tablet"
+COMPUTER_RESPONSE = "Computer"
+
+
+def _select_results(alias=None):
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(prefix + column for column in RESULT_COLUMNS)
+
+
+def _result_from_row(res, store=None, decoder=None):
+    features = res[6]
+    if decoder is None:
+        features = json.loads(features)
+    elif decoder.labels is not None and res[3] not in CHOICE_TYPES:
+        features = {}
+        decoder = None
+
+    return paths.Result(
+        unique_id=res[1],
+        participant=res[2],
+        question_type=res[3],
+        question_stimulus=res[4],
+        response=res[5],
+        features=features,
+        qlabel=res[8],
+        store=store,
+        decoder=decoder,
     )
-    for res in cur.fetchall():
-        results.append(
-            paths.Result(
-                unique_id=res[1],
-                participant=res[2],
-                question_type=res[3],
-                question_stimulus=res[4],
-                response=res[5],
-                features=json.loads(res[6]),
-                qlabel=res[8]
-            )
-        )
 
-    return results
+
+def stream_database(conn, survey_version, batch_size=READ_BATCH_SIZE,
+                    since_id=None, until_id=None, participants=None, store=None,
+                    decoder=None):
+    """
+    Read the results of a survey version through a server-side (named)
+    cursor, so only batch_size rows are held client side at a time.
+
+    :param conn (object) - psycopg2 connection object
+    :param survey_version (int)
+    :param batch_size (int) - rows fetched per round trip
+    :param since_id (int) - only rows with results.id above this
+    :param until_id (int) - only rows with results.id up to this
+    :param participants (list) - only rows for these participants
+    :param store (paths.ResultStore) - hold the features of the results
+    :param decoder (paths.FeatureDecoder) - decode features lazily with this
+
+    :return: generator of paths.Result
+    """
+    conditions = ["survey_version_id = %s"]
+    params = [survey_version]
+    if since_id is not None:
+        conditions.append("id > %s")
+        params.append(since_id)
+    if until_id is not None:
+        conditions.append("id <= %s")
+        params.append(until_id)
+    if participants is not None:
+        conditions.append("participant = ANY(%s)")
+        params.append(list(participants))
+
+    cur = conn.cursor(name=f"results_{survey_version}")
+    cur.itersize = batch_size
+    try:
+        cur.execute(
+            f"""
+            select {_select_results()} from results
+            where {' and '.join(conditions)}
+            """,
+            params,
+        )
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for res in rows:
+                yield _result_from_row(res, store, decoder)
+    finally:
+        cur.close()
+
+
+def read_watermark(cur, survey_version):
+    """Highest results.id currently stored for the survey version."""
+    cur.execute(
+        "select max(id) from results where survey_version_id = %s",
+        (survey_version,),
+    )
+    return cur.fetchone()[0]
 
 
-def read_survey_combination(cur, survey_combination_schema):
+def read_survey_combination(cur, survey_combination_schema, store=None, decoder=None):
     """
     Function to pull results across multiple surveys,
     with option to specify mobile or computer data for each survey
 
+    All surveys are read in one query. Participants who answered the
+    device question with the other device are left out by the server,
+    and results come back survey by survey in the order of the schema.
+
     param survey_combination_schema (dict)
             structure examples {'615': {'computer_only' True, 'mobile_only': False}}
     :param cur (object) - psycopg2 cursor object
+    :param store (paths.ResultStore) - hold the features of the results
+    :param decoder (paths.FeatureDecoder) - decode features lazily with this
 
     :return: results (list)
     """
-    results = []
     logging.info(f'Pulling data from multiple surveys: {survey_combination_schema}')
-    for survey_id in survey_combination_schema:
-        computer_data = True
-        mobile_data = True
-        if survey_combination_schema[survey_id]['computer_only']:
-            mobile_data = False
-        if survey_combination_schema[survey_id]['mobile_only']:
-            computer_data = False
-
-        survey_results = read_database(cur, survey_id)
-        if computer_data and mobile_data:
-            results.extend(survey_results)
 
+    every, computer, mobile = [], [], []
+    for survey_id in survey_combination_schema:
+        computer_only = survey_combination_schema[survey_id]['computer_only']
+        mobile_only = survey_combination_schema[survey_id]['mobile_only']
+
+        # Asking for both leaves nothing of the survey, as before.
+        if computer_only and mobile_only:
+            continue
+        if computer_only:
+            computer.append(int(survey_id))
+        elif mobile_only:
+            mobile.append(int(survey_id))
         else:
-            mob_participants, comp_participants = get_mobile_participants(cur, survey_id)
-            logging.info(f'{survey_id} - Computer Participants: {len(mob_participants)},'
-                         f' Mobile Participants: {len(comp_participants)}')
-            if computer_data:
-                for result in survey_results:
-                    if result.participant not in mob_participants:
-                        results.append(result)
-
-            elif mobile_data:
-                for result in survey_results:
-                    if result.participant not in comp_participants:
-                        results.append(result)
-
-    return results
+            every.append(int(survey_id))
 
+    if not (every or computer or mobile):
+        return []
 
-def get_mobile_participants(cur, survey_version):
-    mobile_participants = []
-    computer_participants = []
+    # Computer only leaves out participants of the survey who answered
+    # the device question with a phone or tablet, and mobile only
+    # those who answered with a computer.
     cur.execute(
         f"""
-        select participant from results 
-        where survey_version_id = {survey_version} and
-        response = 'Phone/Tablet'
-        """
+        select {_select_results("r")} from results r
+        where r.survey_version_id = ANY(%(every)s::int[])
+        or (r.survey_version_id = ANY(%(computer)s::int[]) and not exists (
+            select 1 from results d
+            where d.survey_version_id = r.survey_version_id
+            and d.participant = r.participant
+            and d.response = %(mobile_response)s
+        ))
+        or (r.survey_version_id = ANY(%(mobile)s::int[]) and not exists (
+            select 1 from results d
+            where d.survey_version_id = r.survey_version_id
+            and d.participant = r.participant
+            and d.response = %(computer_response)s
+        ))
+        order by array_position(%(order)s::int[], r.survey_version_id), r.id
+        """,
+        {
+            "every": every,
+            "computer": computer,
+            "mobile": mobile,
+            "order": [int(survey_id) for survey_id in survey_combination_schema],
+            "mobile_response": MOBILE_RESPONSE,
+            "computer_response": COMPUTER_RESPONSE,
+        },
     )
-    for res in cur.fetchall():
-        mobile_participants.append(res[0])
 
-    cur.execute(
-        f"""
-        select participant from results 
-        where survey_version_id = {survey_version} and
-        response = 'Computer'
-        """
-    )
+    results = []
+    counts = {}
     for res in cur.fetchall():
-        computer_participants.append(res[0])
+        counts[res[7]] = counts.get(res[7], 0) + 1
+        results.append(_result_from_row(res, store, decoder))
+
+    for survey_id in survey_combination_schema:
+        logging.info(f'{survey_id} - Results: {counts.get(int(survey_id), 0)}')
 
-    return mobile_participants, computer_participants
+    return results
 
 
 def get_question_key(cur, survey_version):
@@ -162,252 +296,566 @@ def get_question_key(cur, survey_version):
     return qkey
 
 
-def update_analysis(conn, cur, people, survey_version, question_key, filepath):
-    logging.info('Beginning processed_results upload')
-    import pandas as pd
-    provile_df_list = []
+def read_fingerprint(cur, survey_version, until_id):
+    """
+    Number of results of the survey version up to until_id, with
+    until_id itself, which together change whenever results are
+    added or removed.
+    """
+    cur.execute(
+        "select count(*) from results where survey_version_id = %s and id <= %s",
+        (survey_version, until_id),
+    )
+    return [cur.fetchone()[0], until_id]
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_schema(conn):
+    """
+    Create processed_state and add the columns later versions write, once
+    per process and in a transaction of its own. DDL takes an ACCESS
+    EXCLUSIVE lock even when there is nothing to change, so it is kept out
+    of the run's transaction, where the lock would block every other run
+    until the results are committed. A failure is logged and retried on
+    the next run.
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS processed_state (
+                    survey_version_id integer PRIMARY KEY,
+                    last_result_id bigint,
+                    feature_stats jsonb NOT NULL,
+                    certainty_stats jsonb NOT NULL
+                )
+                """
+            )
+            # The stats of the last full run, which incremental runs measure
+            # their shift against. Added to tables made before they were kept.
+            cur.execute(
+                """
+                ALTER TABLE processed_state
+                ADD COLUMN IF NOT EXISTS full_feature_stats jsonb,
+                ADD COLUMN IF NOT EXISTS full_certainty_stats jsonb
+                """
+            )
+            cur.execute("ALTER TABLE processed ADD COLUMN IF NOT EXISTS run_metrics jsonb")
+            conn.commit()
+            _schema_ready = True
+        except psycopg2.Error as e:
+            logger.warning(f"Could not update the processing tables: {e}")
+            conn.rollback()
+        finally:
+            cur.close()
+
+
+def load_state(cur, survey_version):
+    """
+    Read the feature stats and certainty moments stored by the last run,
+    and those of the last full run (None if not stored yet).
+
+    :return: dict with last_result_id, feature_stats, certainty_stats,
+             full_feature_stats, full_certainty_stats or None
+    """
+    cur.execute(
+        """
+        select last_result_id, feature_stats, certainty_stats,
+               full_feature_stats, full_certainty_stats
+        from processed_state
+        where survey_version_id = %s
+        """,
+        (survey_version,),
+    )
+    row = cur.fetchone()
+    if row is None or row[0] is None:
+        return None
+
+    return {
+        "last_result_id": row[0],
+        "feature_stats": row[1],
+        "certainty_stats": row[2],
+        "full_feature_stats": row[3],
+        "full_certainty_stats": row[4],
+    }
+
+
+def save_state(cur, survey_version, last_result_id, fs, certainty_stats, full):
+    # Not committed here, so the state only lands together with the
+    # processed_results it describes. Full runs also store the stats as
+    # the reference for later incremental runs; incremental runs leave
+    # that reference as it is.
+    feature_stats = json.dumps(fs.to_dict())
+    certainty_stats = json.dumps(certainty_stats)
+    cur.execute(
+        """
+        INSERT INTO processed_state
+        (survey_version_id, last_result_id, feature_stats, certainty_stats,
+         full_feature_stats, full_certainty_stats)
+        VALUES
+        (%(sv)s, %(last)s, %(fs)s, %(cs)s, %(full_fs)s, %(full_cs)s)
+        ON CONFLICT (survey_version_id)
+        DO UPDATE
+        SET last_result_id = EXCLUDED.last_result_id,
+            feature_stats = EXCLUDED.feature_stats,
+            certainty_stats = EXCLUDED.certainty_stats,
+            full_feature_stats = COALESCE(EXCLUDED.full_feature_stats,
+                                          processed_state.full_feature_stats),
+            full_certainty_stats = COALESCE(EXCLUDED.full_certainty_stats,
+                                            processed_state.full_certainty_stats)
+        """,
+        {"sv": survey_version, "last": last_result_id, "fs": feature_stats,
+         "cs": certainty_stats, "full_fs": feature_stats if full else None,
+         "full_cs": certainty_stats if full else None},
+    )
+
+
+def save_run_metrics(conn, cur, survey_version, run_metrics):
+    """
+    Store the metrics of the run next to processed.last_processed. A
+    failure here is logged and does not fail the run.
+    """
+    try:
+        cur.execute(
+            "UPDATE processed SET run_metrics = %s WHERE survey_version_id = %s",
+            (run_metrics.to_json(), survey_version),
+        )
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.warning(f"Could not store run metrics: {e}")
+        conn.rollback()
+
+
+# Number of processed_results rows sent per INSERT statement.
+WRITE_BATCH_SIZE = int(os.environ.get("PROCESS_WRITE_BATCH_SIZE", 1000))
+
+# First key of the advisory lock taken while writing a survey version's
+# processed_results; the second key is the survey version.
+WRITE_LOCK_NAMESPACE = 0x4646
+
+
+class ProcessedResultsWriter(object):
+    """
+    Buffer processed_results rows and flush them in batches through
+    psycopg2.extras.execute_values, so values are bound as parameters
+    rather than formatted into the statement.
+
+    Nothing is committed here; the caller owns the transaction.
+    """
+
+    columns = (
+        "survey_version_id",
+        "survey_session_chunk_id",
+        "participant",
+        "question_type",
+        "question_stimulus",
+        "response",
+        "certainty",
+        "qlabel",
+    )
+
+    def __init__(self, cur, batch_size=WRITE_BATCH_SIZE):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        psycopg2.extras.execute_values(
+            self.cur,
+            f"INSERT INTO processed_results ({', '.join(self.columns)}) VALUES %s",
+            self.rows,
+            page_size=self.batch_size,
+        )
+        self.written += len(self.rows)
+        self.rows = []
+
+
+# Write the answers in every person's 'all' category to
+# df_result<survey_version>.csv, one row per variable. The rows are
+# gathered as columns in one pass and framed once, and the stimulus of
+# each variable is looked up in a dict built from question_key.
+def export_profiles(people, survey_version, question_key):
+
+    columns = {
+        "qlabel": [],
+        "response": [],
+        "certainty": [],
+        "participant": [],
+        "suvey_version_id": [],
+    }
+
     for person in people:
-        profile_df = pd.DataFrame(people[person].profile)
-        profile_df = profile_df.reset_index()
-        profile_df = pd.concat([profile_df['index'], profile_df['all'].apply(pd.Series)], axis=1)
-        profile_df.columns = ['qlabel', 'response', 'certainty']
-        profile_df['participant'] = person
-        profile_df['suvey_version_id'] = survey_version
-        provile_df_list.append(profile_df)
-
-
-        #result_df = pd.DataFrame(people[person].results)
-    df_union = pd.concat(provile_df_list, ignore_index=True)
-    print(df_union)
-    question_key_df = pd.DataFrame(question_key)
-    print(question_key_df)
-    df_union['question_stimulus'] = df_union['qlabel'].apply(lambda q: question_key_df[q].iloc[4] if q in question_key_df.columns else None)
-    print(df_union)
-    r = df_union.to_csv(f'df_result{survey_version}.csv')
-    print(r)
-    if True:
-        print('bye!')
-        return 'asd'
+        for var, answer in people[person].profile.get("all", {}).items():
+            columns["qlabel"].append(var)
+            columns["response"].append(answer.get("answer"))
+            columns["certainty"].append(answer.get("certainty"))
+            columns["participant"].append(person)
+            columns["suvey_version_id"].append(survey_version)
+
+    df_union = pd.DataFrame(columns)
+    stimuli = {q: key[4] for q, key in question_key.items()}
+    df_union["question_stimulus"] = df_union["qlabel"].map(stimuli)
 
+    df_union.to_csv(f'df_result{survey_version}.csv')
+    logger.info(f"Exported {len(df_union)} profile rows to df_result{survey_version}.csv")
+
+
+def update_analysis(conn, cur, people, survey_version, question_key, filepath,
+                    batch_size=WRITE_BATCH_SIZE, replace_participants=False):
+    """
+    Write the certainty of every result to processed_results (or to a csv
+    file when filepath is given). All rows for the survey version, and the
+    processed.last_processed marker, go out in a single transaction.
+
+    The rows written replace those already stored: all rows for the
+    survey version, or with replace_participants only those of the given
+    people (used by incremental runs). Writers of the same survey version
+    are serialised by an advisory lock held until the commit, so runs in
+    other workers cannot interleave their rows.
+    """
+    logging.info('Beginning processed_results upload')
 
     if filepath:
-        f = open(filepath, "wt")
-        f = csv.writer(f)
-        f.writerow(["survey_version_id", "survey_session_chunk_id", "participant",
-                    "question_type", "question_stimulus", "response", "certainty"])
+        f = open(filepath, "wt", newline="")
+        writer = csv.writer(f)
+        writer.writerow(["survey_version_id", "survey_session_chunk_id", "participant",
+                         "question_type", "question_stimulus", "response", "certainty"])
+    else:
+        writer = ProcessedResultsWriter(cur, batch_size)
+
     null_count = 0
     non_null_count = 0
-    for person in people:
-        profile = people[person].profile
-        results = people[person].results
-        for key in results:  # survey session chunk
-            result = results[key]
-            ques = result.question_stimulus
-            for row in question_key:
-                if question_key[row][4] == ques:
-                    break
-
-            # Note -> probably a case of issues arising where there are no replies, due to dynamic survey questions.
-            # Question -> does this affect other aspects of the processing?
-            #if (question_key[row][1] in profile) and (question_key[row][0] in profile[question_key[row][1]]):
+    try:
+        if not filepath:
+            cur.execute("SELECT pg_advisory_xact_lock(%s, %s)",
+                        (WRITE_LOCK_NAMESPACE, survey_version))
+
+            if replace_participants:
+                cur.execute(
+                    """
+                    DELETE FROM processed_results
+                    WHERE survey_version_id = %s AND participant = ANY(%s)
+                    """,
+                    (survey_version, list(people)),
+                )
+            else:
+                cur.execute(
+                    "DELETE FROM processed_results WHERE survey_version_id = %s",
+                    (survey_version,),
+                )
 
+        for person in people:
+            profile = people[person].profile
+            results = people[person].results
+            for key in results:  # survey session chunk
+                result = results[key]
+
+                # Note -> probably a case of issues arising where there are no replies, due to dynamic survey questions.
+                # Question -> does this affect other aspects of the processing?
+                if result.qlabel not in question_key:
+                    continue
+                cat = question_key[result.qlabel][1]
+                var = question_key[result.qlabel][0]
                 try:
-                    cert = profile[question_key[row][1]][question_key[row][0]].get("certainty")
-                except Exception as err:
+                    cert = profile[cat][var].get("certainty")
+                except KeyError:
                     continue
-                print('opa')
-                print(f'cert = {cert}')
-                result.question_stimulus = result.question_stimulus.replace("'", "''")
-                result.response = result.response.replace("'", "''")
+
+                if filepath:
+                    if cert is not None:
+                        writer.writerow([survey_version, result.unique_id, person, result.question_type,
+                                         result.question_stimulus, result.response, cert])
+                else:
+                    writer.add((survey_version, result.unique_id, person, result.question_type,
+                                result.question_stimulus, result.response, cert, result.qlabel))
+
                 if cert is not None:
-                    if filepath:
-                        f.writerow([survey_version, result.unique_id, person, result.question_type, result.question_stimulus, result.response, cert])
-                    else:
-                        try:
-                            cur.execute(
-                            f"""INSERT INTO processed_results
-                            (survey_version_id, survey_session_chunk_id, participant, question_type, question_stimulus, response, certainty, qlabel)
-                            VALUES
-                            ({survey_version}, {result.unique_id}, '{person}', '{result.question_type}', '{result.question_stimulus}', '{result.response}', {cert}, '{result.qlabel}') 
-
-                            """
-                            )
-                        except Exception as err:
-                            print(f'error = {err}')
-                            print(
-                                f"""INSERT INTO processed_results
-                                                        (survey_version_id, survey_session_chunk_id, participant, question_type, question_stimulus, response, certainty, qlabel)
-                                                        VALUES
-                                                        ({survey_version}, {result.unique_id}, '{person}', '{result.question_type}', '{result.question_stimulus}', '{result.response}', {cert}, '{result.qlabel}') 
-
-                                                        """
-                            )
-                            conn.rollback()
-
-                            continue
-                        #ON
-                        #CONFLICT(survey_session_chunk_id)
-                        #DO
-                        #UPDATE
-                        #SET
-                        #certainty = EXCLUDED.certainty
                     non_null_count += 1
-                else:
-                    cur.execute(
-                        f"""INSERT INTO processed_results
-                        (survey_version_id, survey_session_chunk_id, participant, question_type, question_stimulus, response, qlabel)
-                        VALUES
-                        ({survey_version}, {result.unique_id}, '{person}', '{result.question_type}', '{result.question_stimulus}', '{result.response}', '{result.qlabel}') 
-                        """
-                    )
-                    #ON
-                    #CONFLICT(survey_session_chunk_id)
-                    #DO
-                    #NOTHING
-                    if result.question_type in ["bipartite_choice", "tripartite_choice"]:
-                        logging.debug(f'Null cert: {result.unique_id}, {person}')
-                        null_count += 1
-            conn.commit()
+                elif result.question_type in ["bipartite_choice", "tripartite_choice"]:
+                    logging.debug(f'Null cert: {result.unique_id}, {person}')
+                    null_count += 1
 
-    if not filepath:
-        try:
+        if not filepath:
+            writer.flush()
             logging.info("Committing results")
             cur.execute(
-                f"""
+                """
                 INSERT INTO processed (survey_version_id, last_processed)
                 VALUES
-                ({survey_version}, '{datetime.datetime.now()}')
+                (%s, %s)
                 ON CONFLICT (survey_version_id)
                 DO UPDATE
                 SET last_processed = EXCLUDED.last_processed 
-                """
+                """,
+                (survey_version, datetime.datetime.now()),
             )
             conn.commit()
 
-        except Exception as e:
-            logging.error(f"Error in commit to DB: {e}", exc_info=True)
+    except Exception as e:
+        logging.error(f"Error in commit to DB: {e}", exc_info=True)
+        if not filepath:
+            conn.rollback()
+        raise
 
-        except psycopg2.error as e:
-            logging.error(f"Error in commit to DB: {e}", exc_info=True)
+    finally:
+        if filepath:
+            f.close()
 
     logging.info(f"Upload completed. Non-null results: {non_null_count}, Null results {null_count}")
 
 
+# Default tolerance for incremental runs: the largest shift, in standard
+# deviations, any series threshold may move before a full re-score is forced.
+INCREMENTAL_TOLERANCE = float(os.environ.get("PROCESS_INCREMENTAL_TOLERANCE", 0.05))
 
-def process(survey_version, surveys_join_schema=None):
-    logger.info(f"Processing started for survey: {survey_version}")
+# How raw certainty scores are bucketed, see rb_models.Calibration.
+CALIBRATION_SCHEME = os.environ.get("PROCESS_CALIBRATION_SCHEME", "sd")
+CALIBRATION_BINS = int(os.environ.get("PROCESS_CALIBRATION_BINS", 10))
 
-    conn = psycopg2.connect(
-        host=os.environ.get("POSTGRES_HOST"),
-        dbname="decipher",
-        user=os.environ.get("POSTGRES_USERNAME"),
-        password=os.environ.get("POSTGRES_PASSWORD"),
-    )
-    #make_st(conn)
+CHOICE_TYPES = ["bipartite_choice", "tripartite_choice"]
 
 
-    # Obtain a cursor for querying.
-    cur = conn.cursor()
+# Add the wall and CPU time since mark to timings[name], returning
+# the new mark.
+def _lap(timings, name, mark):
+    now = time.perf_counter(), time.thread_time()
+    wall, cpu = timings.get(name, (0.0, 0.0))
+    timings[name] = (wall + now[0] - mark[0], cpu + now[1] - mark[1])
+    return now
 
-    people: dict[str, paths.Person] = {}
 
-    fs = features.FeatureStats()
-    model = models.Model()
+def unpack_results(results, question_key, fs, people=None, timings=None):
+    """
+    Fold results into per-participant Person objects and the feature stats.
 
-    # If using specified schema for joining surveys, read this
-    # Otherwise pull all data from specified survey verison
-    if surveys_join_schema:
-        results = read_survey_combination(cur, surveys_join_schema)
-    else:
-        results = read_database(cur, survey_version)
+    If timings (dict) is given, the wall and CPU time spent getting
+    each result from results ("fetch", which for a stream includes the
+    database round trips), adding it to its Person ("unpack") and to
+    the feature stats ("stats") are summed into it as (wall, cpu).
 
-    logger.info(f"Database read complete, {len(results)} results found")
-    question_key = get_question_key(cur, survey_version)
+    :return: people (dict), number of results read
+    """
+    if people is None:
+        people = {}
+
+    if timings is not None:
+        mark = time.perf_counter(), time.thread_time()
 
+    results_read = 0
     for result in results:
+        if timings is not None:
+            mark = _lap(timings, "fetch", mark)
+
         if result.participant not in people:
             people[result.participant] = paths.Person(result.participant, question_key)
 
         people[result.participant].add_result(result)
-        fs.add_result(result)
+        if timings is not None:
+            mark = _lap(timings, "unpack", mark)
+
+        if fs is not None:
+            fs.add_result(result)
+            if timings is not None:
+                mark = _lap(timings, "stats", mark)
+        results_read += 1
+
+    return people, results_read
+
+
+# Worker processes used to normalise and score results, and how many
+# participants each worker task covers. One worker scores in-process.
+WORKERS = int(os.environ.get("PROCESS_WORKERS", 1))
+CHUNK_SIZE = int(os.environ.get("PROCESS_CHUNK_SIZE", 500))
+
+# Worker processes are started from a forkserver rather than forked,
+# as runs are made from JobScheduler threads and a fork copies any lock
+# another thread holds at the time. Workers import this module, so the
+# forkserver loads it once up front; like spawn, it also imports the
+# __main__ module of scripts, which must guard their entry point.
+_workers_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+if _workers_context.get_start_method() == "forkserver":
+    _workers_context.set_forkserver_preload(["process"])
+
+# One pool for every run, started on first use and started again if
+# it breaks (e.g. a worker is killed) or a run asks for another size.
+_workers = None
+_workers_size = 0
+_workers_lock = threading.Lock()
+
+
+def _worker_pool(workers):
+
+    global _workers, _workers_size
+
+    with _workers_lock:
+        if _workers is not None and _workers_size != workers:
+            # Work already submitted by other runs still completes.
+            _workers.shutdown(wait=False)
+            _workers = None
+
+        if _workers is None:
+            _workers = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=_workers_context
+            )
+            _workers_size = workers
 
-    logger.info(f"People unpacked, {len(people)} participants found")
+        return _workers
+
+
+# Shut the pool down when the process exits, releasing its queues.
+@atexit.register
+def _shutdown_worker_pool():
+
+    global _workers
+
+    with _workers_lock:
+        pool, _workers = _workers, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _discard_worker_pool(pool):
+
+    global _workers
+
+    with _workers_lock:
+        if _workers is pool:
+            _workers = None
+    pool.shutdown(wait=False)
+
+
+# Scores and validity of the results, with the wall and CPU time
+# spent normalising and scoring them.
+def _score_results(results, fs, model):
+    wall, cpu = time.perf_counter(), time.thread_time()
+    norm = fs.normalize_batch(results, labels=model.labels())
+    normalised = time.perf_counter(), time.thread_time()
+    scores = model.certainty_batch(norm)
+    scored = time.perf_counter(), time.thread_time()
+    timings = {
+        "normalise": (normalised[0] - wall, normalised[1] - cpu),
+        "score": (scored[0] - normalised[0], scored[1] - normalised[1]),
+    }
+    return scores, norm.valid, timings
+
+
+def score_people(people, fs, model, workers=None, chunk_size=None,
+                 run_metrics=None):
+    """
+    Normalise every choice result against the prepared feature stats and
+    score it, as one batch over all results, or split into chunks of
+    chunk_size participants over the pool of worker processes. workers
+    and chunk_size default to WORKERS and CHUNK_SIZE.
+
+    The normalise and score stages are added to run_metrics, if given,
+    with the time summed over the workers.
+
+    :return: cert_people (dict) person -> [[qlabel, score], ...],
+             certs (list) of every score
+    """
+    if workers is None:
+        workers = WORKERS
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+
+    scored = []
+    chunks = []
+    start = 0
+    for n, person in enumerate(people, 1):
+        for result in people[person].results:
+            if people[person].results[result].question_type not in CHOICE_TYPES:
+                continue
+            scored.append((person, people[person].results[result]))
+
+        if n % chunk_size == 0 or n == len(people):
+            chunks.append([result for _, result in scored[start:]])
+            start = len(scored)
+
+    if run_metrics is not None:
+        run_metrics.start("normalise")
+
+    if workers > 1 and len(chunks) > 1:
+        if not fs.ready:
+            fs.prepare_stats()
+        # The stats and model travel with every chunk, as the pool
+        # outlives the run.
+        pool = _worker_pool(workers)
+        try:
+            parts = list(pool.map(_score_results, chunks, itertools.repeat(fs),
+                                  itertools.repeat(model)))
+        except concurrent.futures.BrokenExecutor:
+            _discard_worker_pool(pool)
+            raise
+        scores = np.concatenate([part[0] for part in parts])
+        valids = np.concatenate([part[1] for part in parts])
+    else:
+        parts = [_score_results([result for _, result in scored], fs, model)]
+        scores, valids, _ = parts[0]
+
+    if run_metrics is not None:
+        for stage in ("normalise", "score"):
+            run_metrics.add(stage, sum(part[2][stage][0] for part in parts),
+                            sum(part[2][stage][1] for part in parts), len(scored),
+                            workers=len(parts))
 
-    del_people = []
     cert_people = {}
-    people_normalised = 0
     results_normalised = 0
     error_enr = 0
     certs = []
-    fs.prepare_stats()
-
-    for person in people:
-        for result in people[person].results:
-            if people[person].results[result].question_type not in [
-                "bipartite_choice",
-                "tripartite_choice",
-            ]:
-                continue
-            try:
-                fs.normalize(people[person].results[result])
-                if person not in cert_people:
-                    cert_people[person] = []
-
-                cert_people[person].append(
-                    [
-                        people[person].results[result].qlabel,
-                        model.certainty(people[person].results[result]),
-                    ]
-                )
 
-                certs.append(cert_people[person][-1][1])
-                results_normalised += 1
+    for (person, result), score, valid in zip(scored, scores, valids):
+        if not valid:
+            logging.error(f"Error in enrichment: Path features must be normalized.")
+            logging.debug(f"ValueError on {person}, {result.qlabel}")
+            error_enr += 1
+            continue
 
-            except ValueError as e:
-                logging.error(f"Error in enrichment: {e}", exc_info=True)
-                logging.debug(vars(people[person].results[result]))
-                logging.debug(f"ValueError on {person}, {e}, {person}, "
-                              f"{people[person].results[result].qlabel}")
-                error_enr += 1
-                # del_people.append(person)
+        if person not in cert_people:
+            cert_people[person] = []
 
-        people_normalised += 1
-        if people_normalised % 100 == 0:
-            logging.info(f"Persons Processed {people_normalised},"
-                         f" Results Normalised: {results_normalised},"
-                         f" Normalisation Errors: {error_enr}")
+        cert_people[person].append([result.qlabel, int(score)])
+        certs.append(cert_people[person][-1][1])
+        results_normalised += 1
 
-    logging.info(f"Persons Processed {people_normalised},"
+    logging.info(f"Persons Processed {len(people)},"
                  f" Results Normalised: {results_normalised},"
                  f" Normalisation Errors: {error_enr}")
 
-    # Calculate necessary stats for certainty.
-    avg = statistics.mean(certs)
+    return cert_people, certs
 
-    sdev = statistics.stdev(certs) if len(certs) >1 else 0.0
-    cert_floor = avg - (2 * sdev)
-    cert_ceil = avg + (2 * sdev)
-    deciles = (cert_ceil - cert_floor) / 10
 
-    # Figure out which decile we are in between 2sd below and 2sd above mean.
+def assign_certainty(people, cert_people, calibration):
+    # Map every score onto its bucket with the fitted calibration in one pass.
+    labels = []
+    scores = []
     for person in cert_people:
         for res in cert_people[person]:
-            if res[1] > cert_ceil:
-                res[1] = cert_ceil
-            if res[1] < cert_floor:
-                res[1] = cert_floor
-            tracker = cert_floor
-            dec = 0
-            while res[1] > tracker:
-                dec += 1
-                tracker += deciles
-            people[person].add_certainty(res[0], dec / 10)
-
-    # Delete broken profiles from analysis.
-    for person in del_people:
-        logger.info(f"{len(del_people)} broken persons detected")
-        del people[person]
+            labels.append((person, res[0]))
+            scores.append(res[1])
 
+    for (person, qlabel), cert in zip(labels, calibration.transform(scores)):
+        people[person].add_certainty(qlabel, float(cert))
+
+
+def add_relative_certainty(people):
     # Add an extra field to each bipartite/tripartite question
     # indicating the relative uncertainty viz benchmarks
     error_enr = 0
@@ -425,10 +873,7 @@ def process(survey_version, surveys_join_schema=None):
             benchmark = statistics.mean(conf)
             # Normalize the paths
             for result in people[person].results:
-                if people[person].results[result].question_type not in [
-                    "bipartite_choice",
-                    "tripartite_choice",
-                ]:
+                if people[person].results[result].question_type not in CHOICE_TYPES:
                     continue
                 people[person].add_relative(
                     benchmark, people[person].results[result].qlabel
@@ -442,10 +887,349 @@ def process(survey_version, surveys_join_schema=None):
 
     logging.info(f'Relative Certainty Errors: {error_enr}')
 
-    update_analysis(conn, cur, people, survey_version, question_key, None)
-    print("Analysis Processing Completed")
 
-    cur.close()
-    conn.close()
+def certainty_moments(certs, moments=None):
+    """
+    Fold scores into running {n, mean, m2} moments (Welford), which is
+    what is persisted between incremental runs instead of every score.
+    """
+    if moments is None:
+        moments = {"n": 0, "mean": 0.0, "m2": 0.0}
+    n, mean, m2 = moments["n"], moments["mean"], moments["m2"]
+    for c in certs:
+        n += 1
+        delta = c - mean
+        mean += delta / n
+        m2 += delta * (c - mean)
+    return {"n": n, "mean": mean, "m2": m2}
+
+
+# Connections kept open between runs, and the most open at once.
+# Runs beyond the maximum wait for a connection to be returned.
+POOL_MIN_CONNECTIONS = int(os.environ.get("PROCESS_POOL_MIN_CONNECTIONS", 1))
+POOL_MAX_CONNECTIONS = int(os.environ.get("PROCESS_POOL_MAX_CONNECTIONS", 4))
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONNECTIONS)
+
+
+# The module's connection pool, created on first use so it lives on
+# across requests (and warm Lambda invocations).
+def connection_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS,
+                POOL_MAX_CONNECTIONS,
+                host=os.environ.get("POSTGRES_HOST"),
+                dbname="decipher",
+                user=os.environ.get("POSTGRES_USERNAME"),
+                password=os.environ.get("POSTGRES_PASSWORD"),
+            )
+        return _pool
+
+
+# Whether a pooled connection still reaches the server.
+def _connection_alive(conn):
+    if conn.closed:
+        return False
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("select 1")
+        finally:
+            cur.close()
+        conn.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def pooled_connection():
+    """
+    A connection from the pool, checked before use and handed back
+    afterwards with any open transaction rolled back. Connections that
+    fail the check or break during use are closed and not reused.
+    """
+    pool = connection_pool()
+    with _pool_slots:
+        conn = pool.getconn()
+        while not _connection_alive(conn):
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+
+        broken = False
+        try:
+            yield conn
+        finally:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def process(survey_version, surveys_join_schema=None, incremental=False,
+            tolerance=INCREMENTAL_TOLERANCE, progress=None, metrics=None):
+    """
+    Run the full pipeline for a survey version and write processed_results.
+
+    With incremental=True, only results added since the last run (tracked in
+    processed_state) are read. If folding them into the stored feature stats
+    moves no threshold by more than tolerance standard deviations, only the
+    participants with new results are re-scored and rewritten; otherwise this
+    falls back to a full run.
+
+    The wall time, CPU time, rows and RSS of every stage are recorded in
+    metrics (a RunMetrics, or a new one), logged as one JSON line and
+    stored in processed.run_metrics. progress, if given, is called with
+    the name of each stage as it starts.
+    """
+    logger.info(f"Processing started for survey: {survey_version}")
+
+    if metrics is None:
+        metrics = RunMetrics()
+    if progress is not None:
+        metrics.progress = progress
+
+    with pooled_connection() as conn:
+        #make_st(conn)
+        ensure_schema(conn)
+
+        # Obtain a cursor for querying.
+        cur = conn.cursor()
+        try:
+            people = _process(conn, cur, survey_version, surveys_join_schema,
+                              incremental, tolerance, metrics)
+
+            logger.info(json.dumps({"survey_version": survey_version,
+                                    "incremental": incremental,
+                                    "run_metrics": metrics.to_dict()}))
+            save_run_metrics(conn, cur, survey_version, metrics)
+
+            return people
+        finally:
+            cur.close()
+
+
+# Directory of the on-disk cache of feature stats and question keys,
+# and the most it may hold. An empty directory turns the cache off.
+STATS_CACHE_DIR = os.environ.get(
+    "PROCESS_STATS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ffml-stats-cache")
+)
+STATS_CACHE_BYTES = int(os.environ.get("PROCESS_STATS_CACHE_BYTES", 256 * 2 ** 20))
+
+stats_cache = StatsCache(STATS_CACHE_DIR, STATS_CACHE_BYTES) if STATS_CACHE_DIR else None
+
+
+# Stats cache key of a survey version. Projected loading only keeps
+# the model's features, so its stats also depend on the labels.
+def stats_cache_key(survey_version, model):
+    key = f"{survey_version}-{FEATURE_LOADING}"
+    if FEATURE_LOADING == "projected":
+        labels = json.dumps(sorted(model.labels())).encode("utf-8")
+        key += "-" + hashlib.sha1(labels).hexdigest()[:12]
+    return key
+
+
+def _process(conn, cur, survey_version, surveys_join_schema, incremental, tolerance,
+             run_metrics):
+    model = models.Model()
+
+    with run_metrics.stage("setup"):
+
+        # Multi-survey joins carry no per-survey state to resume from.
+        track_state = not surveys_join_schema
+        if track_state:
+            last_result_id = read_watermark(cur, survey_version)
+
+        # Stats and question key of an unchanged survey version come
+        # from the cache.
+        cached = None
+        fingerprint = None
+        if track_state and stats_cache is not None and last_result_id is not None:
+            fingerprint = read_fingerprint(cur, survey_version, last_result_id)
+            cached = stats_cache.get(stats_cache_key(survey_version, model), fingerprint)
+
+        if cached is not None:
+            logger.info(f"Feature stats and question key taken from cache, {fingerprint[0]} results")
+            question_key, fs = cached
+        else:
+            question_key = get_question_key(cur, survey_version)
+            fs = features.FeatureStats()
+
+    if incremental and track_state:
+        people = process_incremental(conn, cur, model, survey_version, question_key,
+                                     last_result_id, tolerance, run_metrics)
+        if people is not None:
+            return people
+
+    # Raw features are held column-wise for the whole run.
+    store = paths.ResultStore()
+    decoder = feature_decoder(model)
+
+    # If using specified schema for joining surveys, read this
+    # Otherwise pull all data from specified survey verison
+    # Single surveys are streamed, so results are unpacked and folded
+    # into the stats as rows arrive; reading, unpacking and folding are
+    # timed together as the read stage, and apart in its "parts".
+    with run_metrics.stage("read") as stage:
+        if surveys_join_schema:
+            results = read_survey_combination(cur, surveys_join_schema, store, decoder)
+        else:
+            results = stream_database(conn, survey_version, until_id=last_result_id,
+                                      store=store, decoder=decoder)
+
+        stage["parts"] = {}
+        people, results_read = unpack_results(results, question_key,
+                                              fs if cached is None else None,
+                                              timings=stage["parts"])
+        stage["rows"] = results_read
+        stage["participants"] = len(people)
+
+    logger.info(f"Database read complete, {results_read} results found")
+    logger.info(f"People unpacked, {len(people)} participants found")
+
+    with run_metrics.stage("stats", len(fs.features)) as stage:
+        if cached is None and fingerprint is not None:
+            stats_cache.put(stats_cache_key(survey_version, model), fingerprint,
+                            question_key, fs)
+        fs.prepare_stats()
+        stage["cached"] = cached is not None
+
+    cert_people, certs = score_people(people, fs, model, run_metrics=run_metrics)
+
+    with run_metrics.stage("calibrate", len(certs)):
+        # Calculate necessary stats for certainty.
+        calibration = models.Calibration(CALIBRATION_SCHEME, CALIBRATION_BINS).fit(certs)
+        assign_certainty(people, cert_people, calibration)
+
+    with run_metrics.stage("relative", len(people)):
+        add_relative_certainty(people)
+
+    with run_metrics.stage("write", len(people)):
+        if track_state:
+            certainty_stats = certainty_moments(certs)
+            certainty_stats["calibration"] = calibration.to_dict()
+            save_state(cur, survey_version, last_result_id, fs, certainty_stats, full=True)
+
+        update_analysis(conn, cur, people, survey_version, question_key, None)
+
+    with run_metrics.stage("export", len(people)):
+        export_profiles(people, survey_version, question_key)
+
+    logger.info("Analysis Processing Completed")
+
+    return people
+
+
+def process_incremental(conn, cur, model, survey_version, question_key,
+                        last_result_id, tolerance, run_metrics=None):
+    """
+    Incremental half of process(). Returns the re-scored people, or None
+    when a full run is needed instead.
+    """
+    if run_metrics is None:
+        run_metrics = RunMetrics()
+
+    state = load_state(cur, survey_version)
+    if state is None:
+        logger.info(f"No stored state for survey {survey_version}, running in full")
+        return None
+
+    if last_result_id is None or last_result_id <= state["last_result_id"]:
+        logger.info(f"No new results for survey {survey_version} since last run")
+        return {}
+
+    # The shift is measured from the last full run rather than the last
+    # run, so increments cannot each stay in tolerance while drifting
+    # further away from the stats every profile was last scored against.
+    if state["full_feature_stats"] is None:
+        logger.info(f"No stored full-run stats for survey {survey_version}, running in full")
+        return None
+
+    reference = features.FeatureStats.from_dict(state["full_feature_stats"])
+    fs = features.FeatureStats.from_dict(state["feature_stats"])
+    reference.prepare_stats()
+
+    new_ids = set()
+    touched = set()
+    results_read = 0
+    decoder = feature_decoder(model)
+
+    # New results are streamed straight into the stats.
+    with run_metrics.stage("stats") as stage:
+        for result in stream_database(conn, survey_version,
+                                      since_id=state["last_result_id"], until_id=last_result_id,
+                                      decoder=decoder):
+            fs.add_result(result)
+            new_ids.add(result.unique_id)
+            touched.add(result.participant)
+            results_read += 1
+
+        fs.prepare_stats()
+        stage["rows"] = results_read
+    shift = reference.max_shift(fs, model.labels())
+    logger.info(f"Incremental read complete, {results_read} new results from "
+                f"{len(touched)} participants, stats shift {shift:.4f}")
+    if shift > tolerance:
+        logger.info(f"Stats shift above tolerance {tolerance}, running in full")
+        return None
+
+    # Re-read every result of the touched participants; their earlier
+    # answers feed the profile and the benchmark comparison.
+    with run_metrics.stage("unpack") as stage:
+        people, stage["rows"] = unpack_results(
+            stream_database(conn, survey_version, until_id=last_result_id,
+                            participants=sorted(touched), store=paths.ResultStore(),
+                            decoder=decoder),
+            question_key, None,
+        )
+        stage["participants"] = len(people)
+
+    cert_people, certs = score_people(people, fs, model, run_metrics=run_metrics)
+
+    new_certs = []
+    for person in cert_people:
+        for qlabel, cert in cert_people[person]:
+            if people[person].results[qlabel].unique_id in new_ids:
+                new_certs.append(cert)
+    moments = certainty_moments(new_certs, state["certainty_stats"])
+
+    # The 'sd' scheme is refitted from the updated moments; other schemes
+    # keep the edges fitted by the last full run.
+    full_calibration = (state["full_certainty_stats"] or {}).get("calibration", {})
+    if CALIBRATION_SCHEME == "sd":
+        sdev = math.sqrt(moments["m2"] / (moments["n"] - 1)) if moments["n"] > 1 else 0.0
+        calibration = models.Calibration(CALIBRATION_SCHEME, CALIBRATION_BINS)
+        calibration.fit_moments(moments["mean"], sdev)
+    elif full_calibration.get("scheme") == CALIBRATION_SCHEME:
+        calibration = models.Calibration.from_dict(full_calibration)
+    else:
+        logger.info(f"No stored '{CALIBRATION_SCHEME}' calibration, running in full")
+        return None
+
+    with run_metrics.stage("calibrate", len(certs)):
+        assign_certainty(people, cert_people, calibration)
+
+    with run_metrics.stage("relative", len(people)):
+        add_relative_certainty(people)
+
+    with run_metrics.stage("write", len(people)):
+        moments["calibration"] = calibration.to_dict()
+        save_state(cur, survey_version, last_result_id, fs, moments, full=False)
+        update_analysis(conn, cur, people, survey_version, question_key, None,
+                        replace_participants=True)
+
+    # Only the re-scored participants are held here, so the profile CSV
+    # is left as the last full run wrote it rather than cut down to them.
+    logger.info(f"Profile export skipped on incremental runs, df_result{survey_version}.csv "
+                f"is from the last full run")
+
+    logger.info("Analysis Processing Completed")
 
     return people
@@ -0,0 +1,54 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+
+from logger import get_logger
+
+logger = get_logger('process.profiling')
+
+# Where profiles are written, and how many functions the summary lists.
+PROFILE_DIR = os.environ.get(
+    "PROCESS_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "ffml-profiles")
+)
+PROFILE_TOP = int(os.environ.get("PROCESS_PROFILE_TOP", 30))
+
+
+##############################################################################
+#
+# Profiling of code run in the calling thread with cProfile. The raw
+# stats are written to <name>.prof, for pstats or snakeviz, and a
+# summary of the top functions by own time and by cumulative time to
+# <name>.txt. Worker processes started inside are not profiled.
+#
+##############################################################################
+
+
+@contextlib.contextmanager
+def profiling(name, directory=PROFILE_DIR, top=PROFILE_TOP):
+
+    os.makedirs(directory, exist_ok=True)
+    files = {
+        "stats": os.path.join(directory, f"{name}.prof"),
+        "summary": os.path.join(directory, f"{name}.txt"),
+    }
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield files
+    finally:
+        profiler.disable()
+        profiler.dump_stats(files["stats"])
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        for order in ("tottime", "cumulative"):
+            summary.write(f"Top {top} functions by {order}\n")
+            stats.sort_stats(order).print_stats(top)
+        with open(files["summary"], "w") as f:
+            f.write(summary.getvalue())
+
+        logger.info(f"Profile written to {files['stats']}")
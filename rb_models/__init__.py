@@ -1 +1,2 @@
 from rb_models.models import *
+from rb_models.calibration import *
@@ -0,0 +1,129 @@
+import itertools
+import statistics
+
+import numpy as np
+
+############################################################################
+#
+# The Calibration class maps raw certainty scores (certain - uncertain)
+# onto buckets in the 0:1 range. It is fitted on the scores of the
+# whole reference group, then applied to any score in one vectorised
+# pass, so it can be run and tuned on its own.
+#
+# Schemes:
+# 	'sd'       - clamp to mean +/- width standard deviations and split
+# 	             that range into equal bins; 0.0 is the floor itself,
+# 	             1.0 the top bin (the original decile mapping).
+# 	'quantile' - split at the empirical quantiles of the fitted
+# 	             scores, so every bin holds about the same share.
+#
+############################################################################
+
+
+class Calibration(object):
+
+    schemes = ("sd", "quantile")
+
+    def __init__(self, scheme="sd", bins=10, width=2):
+
+        if scheme not in self.schemes:
+            raise ValueError(f"Unknown calibration scheme: {scheme}")
+
+        if bins < 1:
+            raise ValueError("Calibration needs at least one bin.")
+
+        self.scheme = scheme
+        self.bins = bins
+        self.width = width
+
+        # Interior bin edges, set by fitting.
+        self.edges = None
+        self.floor = None
+        self.ceil = None
+
+    # Fit the bin edges on a reference set of scores.
+    def fit(self, scores):
+
+        scores = list(scores)
+
+        if self.scheme == "sd":
+            avg = statistics.mean(scores)
+            sdev = statistics.stdev(scores) if len(scores) > 1 else 0.0
+            return self.fit_moments(avg, sdev)
+
+        if not scores:
+            raise ValueError("No scores to calibrate.")
+
+        self.floor = min(scores)
+        self.ceil = max(scores)
+        self.edges = np.quantile(
+            np.asarray(scores, dtype=float), np.arange(1, self.bins) / self.bins
+        )
+
+        return self
+
+    # Fit the 'sd' scheme from the mean and standard deviation
+    # alone, e.g. when only running moments are kept.
+    def fit_moments(self, avg, sdev):
+
+        if self.scheme != "sd":
+            raise ValueError(f"Scheme '{self.scheme}' cannot be fitted from moments.")
+
+        self.floor = avg - (self.width * sdev)
+        self.ceil = avg + (self.width * sdev)
+        step = (self.ceil - self.floor) / self.bins
+
+        # Edges are accumulated step by step rather than computed as
+        # floor + k * step, so scores land in the same bins as with
+        # the original running tracker.
+        self.edges = np.array(
+            list(itertools.accumulate([self.floor] + [step] * (self.bins + 2)))
+        )
+
+        return self
+
+    # Map scores onto their bucket in the 0:1 range.
+    def transform(self, scores):
+
+        if self.edges is None:
+            raise ValueError("Calibration must be fitted first.")
+
+        scores = np.clip(np.asarray(scores, dtype=float), self.floor, self.ceil)
+
+        if self.scheme == "sd":
+            # Number of edges strictly below the score, which is how
+            # many steps the floor must take to reach it.
+            return np.searchsorted(self.edges, scores, side="left") / self.bins
+
+        if self.bins == 1:
+            return np.ones(len(scores))
+
+        return np.searchsorted(self.edges, scores, side="right") / (self.bins - 1)
+
+    def fit_transform(self, scores):
+
+        scores = list(scores)
+
+        return self.fit(scores).transform(scores)
+
+    def to_dict(self):
+
+        return {
+            "scheme": self.scheme,
+            "bins": self.bins,
+            "width": self.width,
+            "floor": self.floor,
+            "ceil": self.ceil,
+            "edges": None if self.edges is None else self.edges.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+
+        calibration = cls(data["scheme"], data["bins"], data["width"])
+        calibration.floor = data["floor"]
+        calibration.ceil = data["ceil"]
+        if data["edges"] is not None:
+            calibration.edges = np.array(data["edges"])
+
+        return calibration
@@ -1,7 +1,140 @@
+import numpy as np
+
+# Normalised feature flags behind the certainty score. Certainty is
+# proxied by less hovering, faster trajectories, straighter
+# trajectories, fewer switches of focus--relative to the peer group.
+# Each flag in a *_TRUTHS list adds a point when set, each flag in
+# a *_FALSES list adds a point when unset.
+CERTAIN_TRUTHS = [
+    "averageDivergence_below_1sd",
+    "averageSpeed_above_avg",
+    "averageSpeed_above_1sd",
+    "cumulativeDivergence_below_1sd",
+    "lateSpeed_above_avg",
+    "lateSpeed_above_1sd",
+    "maxDivergence_below_1sd",
+    "numBackAndForth_below_1sd",
+    "pathCrossing_below_1sd",
+    "quadMaxDistance_below_1sd",
+    "quadTotalDistance1_below_1sd",
+    "quadTotalDistance2_below_1sd",
+    "quadTotalDistance3_below_1sd",
+    "quadTotalDistance4_below_1sd",
+    "totalDistance_below_1sd",
+    "variance_below_1sd",
+]
+
+CERTAIN_FALSES = [
+    "averageDivergence_above_avg",
+    "cumulativeDivergence_above_avg",
+    "maxDivergence_above_avg",
+    "numBackAndForth_above_avg",
+    "numHover_above_avg",
+    "otherHover",
+    "upperHover",
+    "otherQuadLate",
+    "pathCrossing_above_avg",
+    "quadMaxDistance_above_avg",
+    "quadTotalDistance1_above_avg",
+    "quadTotalDistance2_above_avg",
+    "quadTotalDistance3_above_avg",
+    "quadTotalDistance4_above_avg",
+    "targetHover",
+    "totalDistance_above_avg",
+    "variance_above_avg",
+]
+
+UNCERTAIN_TRUTHS = [
+    "averageDivergence_above_1sd",
+    "averageSpeed_below_1sd",
+    "cumulativeDivergence_above_1sd",
+    "lateSpeed_below_1sd",
+    "maxDivergence_above_1sd",
+    "numBackAndForth_above_1sd",
+    "pathCrossing_above_1sd",
+    "quadMaxDistance_above_1sd",
+    "quadTotalDistance1_above_1sd",
+    "quadTotalDistance2_above_1sd",
+    "quadTotalDistance3_above_1sd",
+    "quadTotalDistance4_above_1sd",
+    "totalDistance_above_1sd",
+    "variance_above_1sd",
+    "averageDivergence_above_avg",
+    "cumulativeDivergence_above_avg",
+    "maxDivergence_above_avg",
+    "numBackAndForth_above_avg",
+    "numHover_above_avg",
+    "otherHover",
+    "upperHover",
+    "otherQuadLate",
+    "pathCrossing_above_avg",
+    "quadMaxDistance_above_avg",
+    "quadTotalDistance1_above_avg",
+    "quadTotalDistance2_above_avg",
+    "quadTotalDistance3_above_avg",
+    "quadTotalDistance4_above_avg",
+    "targetHover",
+    "totalDistance_above_avg",
+    "variance_above_avg",
+]
+
+UNCERTAIN_FALSES = ["averageSpeed_above_avg", "lateSpeed_above_avg"]
+
+
+# Net effect of each flag on certain - uncertain when it is set.
+# A flag in a *_FALSES list scores when unset, so it weighs -1 when
+# set and its point moves into BASE_SCORE, the score of a result
+# with no flags set at all.
+def _flag_weights():
+
+    weights = {}
+
+    for flag in CERTAIN_TRUTHS + UNCERTAIN_FALSES:
+        weights[flag] = weights.get(flag, 0) + 1
+
+    for flag in CERTAIN_FALSES + UNCERTAIN_TRUTHS:
+        weights[flag] = weights.get(flag, 0) - 1
+
+    return {flag: w for flag, w in weights.items() if w}
+
+
+FLAG_WEIGHTS = _flag_weights()
+BASE_SCORE = len(CERTAIN_FALSES) - len(UNCERTAIN_FALSES)
+
+# Suffixes added to a raw feature label by FeatureStats normalisation.
+FLAG_SUFFIXES = (
+    "_above_avg",
+    "_above_1sd",
+    "_above_2sd",
+    "_below_1sd",
+    "_below_2sd",
+    "_above_var",
+    "_above_var_1sd",
+    "_above_var_2sd",
+    "_below_var_1sd",
+    "_below_var_2sd",
+    "_predominant",
+)
+
+
 # A class to classify paths by behavioural features
 # in a rule based manner.
 class Model(object):
 
+    # The raw feature labels the certainty rules are built on.
+    def labels(self):
+
+        labels = set()
+
+        for flag in CERTAIN_TRUTHS + CERTAIN_FALSES + UNCERTAIN_TRUTHS + UNCERTAIN_FALSES:
+            for suffix in sorted(FLAG_SUFFIXES, key=len, reverse=True):
+                if flag.endswith(suffix):
+                    flag = flag[: -len(suffix)]
+                    break
+            labels.add(flag)
+
+        return labels
+
     def certainty(self, result):
 
         if not result.norm_features:
@@ -9,103 +142,25 @@ class Model(object):
 
         confidence = 0.0
 
-        # Certainty is proxied by less hovering, faster
-        # trajectories, straighter trajectories, fewer
-        # switches of focus--relative to the peer group.
-        truths = [
-            "averageDivergence_below_1sd",
-            "averageSpeed_above_avg",
-            "averageSpeed_above_1sd",
-            "cumulativeDivergence_below_1sd",
-            "lateSpeed_above_avg",
-            "lateSpeed_above_1sd",
-            "maxDivergence_below_1sd",
-            "numBackAndForth_below_1sd",
-            "pathCrossing_below_1sd",
-            "quadMaxDistance_below_1sd",
-            "quadTotalDistance1_below_1sd",
-            "quadTotalDistance2_below_1sd",
-            "quadTotalDistance3_below_1sd",
-            "quadTotalDistance4_below_1sd",
-            "totalDistance_below_1sd",
-            "variance_below_1sd",
-        ]
-
-        falses = [
-            "averageDivergence_above_avg",
-            "cumulativeDivergence_above_avg",
-            "maxDivergence_above_avg",
-            "numBackAndForth_above_avg",
-            "numHover_above_avg",
-            "otherHover",
-            "upperHover",
-            "otherQuadLate",
-            "pathCrossing_above_avg",
-            "quadMaxDistance_above_avg",
-            "quadTotalDistance1_above_avg",
-            "quadTotalDistance2_above_avg",
-            "quadTotalDistance3_above_avg",
-            "quadTotalDistance4_above_avg",
-            "targetHover",
-            "totalDistance_above_avg",
-            "variance_above_avg",
-        ]
-
         certain = 0
 
-        for i in truths:
+        for i in CERTAIN_TRUTHS:
             if result.norm_features.get(i):
                 certain += 1
 
-        for i in falses:
+        for i in CERTAIN_FALSES:
             if not result.norm_features.get(i):
                 certain += 1
 
         # Now calculate the other side: uncertainty.
-        truths = [
-            "averageDivergence_above_1sd",
-            "averageSpeed_below_1sd",
-            "cumulativeDivergence_above_1sd",
-            "lateSpeed_below_1sd",
-            "maxDivergence_above_1sd",
-            "numBackAndForth_above_1sd",
-            "pathCrossing_above_1sd",
-            "quadMaxDistance_above_1sd",
-            "quadTotalDistance1_above_1sd",
-            "quadTotalDistance2_above_1sd",
-            "quadTotalDistance3_above_1sd",
-            "quadTotalDistance4_above_1sd",
-            "totalDistance_above_1sd",
-            "variance_above_1sd",
-            "averageDivergence_above_avg",
-            "cumulativeDivergence_above_avg",
-            "maxDivergence_above_avg",
-            "numBackAndForth_above_avg",
-            "numHover_above_avg",
-            "otherHover",
-            "upperHover",
-            "otherQuadLate",
-            "pathCrossing_above_avg",
-            "quadMaxDistance_above_avg",
-            "quadTotalDistance1_above_avg",
-            "quadTotalDistance2_above_avg",
-            "quadTotalDistance3_above_avg",
-            "quadTotalDistance4_above_avg",
-            "targetHover",
-            "totalDistance_above_avg",
-            "variance_above_avg",
-        ]
-
-        falses = ["averageSpeed_above_avg", "lateSpeed_above_avg"]
-
         uncertain = 0
 
-        for i in truths:
+        for i in UNCERTAIN_TRUTHS:
 
             if result.norm_features.get(i):
                 uncertain += 1
 
-        for i in falses:
+        for i in UNCERTAIN_FALSES:
 
             if not result.norm_features.get(i):
                 uncertain += 1
@@ -144,6 +199,22 @@ class Model(object):
 
         return confidence '''
 
+    # Score many results at once from a features.NormFeatures
+    # matrix: the same certain - uncertain as certainty(), as one
+    # dot product of the flags with a +1/-1 weight vector. Rows
+    # with nothing normalised (norm.valid False), which certainty()
+    # would reject, come back as NaN.
+    def certainty_batch(self, norm):
+
+        columns = [c for c in FLAG_WEIGHTS if c in norm.index]
+        weights = np.array([FLAG_WEIGHTS[c] for c in columns], dtype=np.int64)
+
+        flags = norm.flags[:, [norm.index[c] for c in columns]]
+        scores = (flags @ weights + BASE_SCORE).astype(float)
+        scores[~norm.valid] = np.nan
+
+        return scores
+
     def veracity(self, result):
 
         if not result.norm_features:
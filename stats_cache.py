@@ -0,0 +1,130 @@
+import json
+import os
+import tempfile
+import zlib
+
+import features
+from logger import get_logger
+
+logger = get_logger('process.stats_cache')
+
+# Bumped whenever the layout of an entry changes, so older entries
+# are treated as misses.
+CACHE_VERSION = 1
+
+SUFFIX = ".stats"
+
+
+##############################################################################
+#
+# StatsCache keeps the FeatureStats and question key of a survey version
+# on disk between runs, with the fingerprint of the results they were
+# built from. While the fingerprint still matches (no results added or
+# removed), a run can take them from here instead of rebuilding them.
+#
+# Each key has one entry, replaced whenever its fingerprint changes.
+# The directory is kept under max_bytes by removing the entries used
+# least recently.
+#
+##############################################################################
+
+
+class StatsCache(object):
+
+    def __init__(self, directory, max_bytes):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{SUFFIX}")
+
+    # (question_key, FeatureStats) stored for the key, or None if
+    # there is no entry for this fingerprint.
+    def get(self, key, fingerprint):
+
+        path = self._path(key)
+
+        try:
+            with open(path, "rb") as f:
+                entry = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zlib.error):
+            logger.warning(f"Discarding unreadable stats cache entry: {path}")
+            self._remove(path)
+            return None
+
+        if entry.get("version") != CACHE_VERSION or entry.get("fingerprint") != list(fingerprint):
+            return None
+
+        # Mark as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entry["question_key"], features.FeatureStats.from_dict(entry["feature_stats"])
+
+    def put(self, key, fingerprint, question_key, fs):
+
+        entry = {
+            "version": CACHE_VERSION,
+            "fingerprint": list(fingerprint),
+            "question_key": question_key,
+            "feature_stats": fs.to_dict(),
+        }
+        data = zlib.compress(json.dumps(entry, separators=(",", ":")).encode("utf-8"))
+
+        # The cache only saves time, so an entry that cannot be written
+        # (a full disk, a read-only directory) does not fail the run.
+        try:
+            self._write(key, data)
+            self._evict()
+        except OSError as err:
+            logger.warning(f"Could not write stats cache entry {key}: {err}")
+
+    def _write(self, key, data):
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Written aside and moved into place, so readers never see
+        # half an entry.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            self._remove(tmp)
+            raise
+
+    # Remove the least recently used entries until the cache fits.
+    def _evict(self):
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logger.warning(f"Could not remove stats cache file {path}: {err}")
@@ -0,0 +1,127 @@
+"""
+Calibration('sd') must put every certainty score in the decile the
+original bucketing loop in process.py put it in, kept below as it was.
+The loop walks up from the floor in running steps, so scores on or next
+to a step edge are where the two could part; integer scores, as
+certainty() gives, land on the edges often, as do scores past the
+clamps and sets whose deviation is zero.
+
+Run from the repository root:
+
+    python -m unittest discover tests
+"""
+import random
+import statistics
+import unittest
+
+import rb_models as models
+
+SEED = 8
+
+
+##############################################################################
+#
+# The original bucketing, from the certainty stage of process().
+#
+##############################################################################
+
+
+# reference, if given, is the set of scores the moments are taken from.
+def deciles(certs, reference=None):
+
+    if reference is None:
+        reference = certs
+
+    avg = statistics.mean(reference)
+
+    sdev = statistics.stdev(reference) if len(reference) > 1 else 0.0
+    cert_floor = avg - (2 * sdev)
+    cert_ceil = avg + (2 * sdev)
+    deciles = (cert_ceil - cert_floor) / 10
+
+    buckets = []
+    for cert in certs:
+        if cert > cert_ceil:
+            cert = cert_ceil
+        if cert < cert_floor:
+            cert = cert_floor
+        tracker = cert_floor
+        dec = 0
+        while cert > tracker:
+            dec += 1
+            tracker += deciles
+        buckets.append(dec / 10)
+
+    return buckets
+
+
+# Scores of the kinds certainty() and its callers give.
+def random_scores(rng, count):
+
+    kind = rng.choice(["int", "narrow", "float", "skewed"])
+
+    if kind == "int":
+        return [rng.randint(-20, 20) for _ in range(count)]
+    if kind == "narrow":
+        return [rng.choice([-1, 0, 0, 1, 2]) for _ in range(count)]
+    if kind == "float":
+        return [rng.gauss(0, 5) for _ in range(count)]
+
+    return [rng.choice([0, 0, 0, 1, 40]) for _ in range(count)]
+
+
+##############################################################################
+#
+# Tests.
+#
+##############################################################################
+
+
+class CalibrationTest(unittest.TestCase):
+
+    # Compares the buckets of the loop and of a calibration (fitted
+    # on certs if not given), listing the scores that differ as
+    # (score, loop, calibration).
+    def assertSame(self, certs, calibration=None, reference=None):
+
+        expected = deciles(certs, reference)
+        if calibration is None:
+            buckets = models.Calibration("sd").fit_transform(certs)
+        else:
+            buckets = calibration.transform(certs)
+
+        self.assertEqual(
+            [(c, e, b) for c, e, b in zip(certs, expected, buckets.tolist()) if e != b],
+            [],
+        )
+
+    def test_random_scores(self):
+
+        rng = random.Random(SEED)
+        for case in range(300):
+            certs = random_scores(rng, rng.randint(1, 400))
+            with self.subTest(case=case, scores=len(certs)):
+                self.assertSame(certs)
+
+    def test_degenerate_scores(self):
+
+        for certs in ([0], [5], [3, 3, 3], [-2.5] * 10, [0, 1], [1, 0, 0, 0]):
+            with self.subTest(certs=certs):
+                self.assertSame(certs)
+
+    def test_saved_calibration(self):
+
+        # A calibration carried over from a full run buckets new
+        # scores as the loop would with the full run's moments.
+        rng = random.Random(SEED)
+        reference = random_scores(rng, 500)
+        calibration = models.Calibration.from_dict(
+            models.Calibration("sd").fit(reference).to_dict()
+        )
+        extra = [rng.randint(-30, 30) for _ in range(100)]
+
+        self.assertSame(extra, calibration, reference)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Model.certainty_batch must score every row of a NormFeatures matrix as
+Model.certainty scores the same flags as a norm_features dict: the same
+certain - uncertain, and NaN where certainty() would refuse a result
+with nothing normalised. Flags are drawn at random over every column
+the rules use, with some columns missing from the matrix altogether and
+some it does not use, and also taken from FeatureStats.normalize_batch.
+
+Run from the repository root:
+
+    python -m unittest discover tests
+"""
+import math
+import random
+import unittest
+
+import numpy as np
+
+import features
+import paths
+import rb_models as models
+
+SEED = 7
+
+RULE_FLAGS = sorted(set(
+    models.CERTAIN_TRUTHS + models.CERTAIN_FALSES
+    + models.UNCERTAIN_TRUTHS + models.UNCERTAIN_FALSES
+))
+
+
+##############################################################################
+#
+# Normalised flags.
+#
+##############################################################################
+
+
+# A NormFeatures of random flags over the rule flags, less a few,
+# and some flags the rules do not use.
+def random_norm(rng, rows):
+
+    columns = [c for c in RULE_FLAGS if rng.random() < 0.9]
+    columns += ["earlySpeed_above_avg", "earlyHover", "firstQuad_predominant"]
+    rng.shuffle(columns)
+
+    density = rng.choice([0.05, 0.5, 0.95])
+    flags = np.array(
+        [[rng.random() < density for _ in columns] for _ in range(rows)], dtype=bool
+    ).reshape(rows, len(columns))
+    valid = np.array([rng.random() < 0.95 for _ in range(rows)], dtype=bool)
+
+    return features.NormFeatures(flags, columns, valid)
+
+
+# The certainty() of each row of a NormFeatures, or NaN where it
+# raises.
+def certainties(model, norm):
+
+    scores = []
+    for i in range(len(norm)):
+        result = paths.Result(i, "p", {}, "bipartite_choice", None, None, f"q{i}")
+        result.norm_features = norm.row(i)
+        try:
+            scores.append(float(model.certainty(result)))
+        except ValueError:
+            scores.append(math.nan)
+
+    return scores
+
+
+##############################################################################
+#
+# Tests.
+#
+##############################################################################
+
+
+class CertaintyBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = models.Model()
+
+    def assertSame(self, norm):
+        self.assertEqual(
+            [repr(s) for s in certainties(self.model, norm)],
+            [repr(float(s)) for s in self.model.certainty_batch(norm)],
+        )
+
+    def test_random_flags(self):
+
+        rng = random.Random(SEED)
+        for case in range(50):
+            norm = random_norm(rng, rng.randint(0, 60))
+            with self.subTest(case=case, rows=len(norm)):
+                self.assertSame(norm)
+
+    def test_every_flag_alone(self):
+
+        # One flag set per row isolates the weight of each flag,
+        # including those in both a certain and an uncertain list.
+        columns = RULE_FLAGS
+        flags = np.vstack([np.zeros(len(columns), dtype=bool), np.eye(len(columns), dtype=bool)])
+        valid = np.ones(len(flags), dtype=bool)
+
+        self.assertSame(features.NormFeatures(flags, columns, valid))
+
+    def test_normalize_batch(self):
+
+        rng = random.Random(SEED)
+        labels = sorted(self.model.labels())
+        results = []
+        for i in range(300):
+            series = {
+                l: [rng.uniform(-1, 3), "series"]
+                for l in labels if not l.endswith(("Hover", "QuadLate")) and rng.random() < 0.9
+            }
+            bools = {
+                l: [rng.random() < 0.3, "bool"]
+                for l in labels if l.endswith(("Hover", "QuadLate")) and rng.random() < 0.9
+            }
+            results.append(paths.Result(
+                i, "p", {"series": series, "bools": bools} if rng.random() < 0.95 else {},
+                "bipartite_choice", None, None, f"q{i}",
+            ))
+
+        fs = features.FeatureStats()
+        for result in results:
+            fs.add_result(result)
+
+        self.assertSame(fs.normalize_batch(results, self.model.labels()))
+
+
+if __name__ == "__main__":
+    unittest.main()
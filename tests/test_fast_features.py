@@ -0,0 +1,227 @@
+"""
+FastPathFeatures must return exactly what PathFeatures returns. The
+crossing count and the hover windows rest on hand-derived floating-point
+tolerances (the grid slack, the collinear tolerance, the hover margin),
+so they are compared on random paths and on the degenerate ones those
+tolerances exist for: collinear and backtracking paths, paths on a
+coarse grid, dense dwells close to the hover radius, repeated points
+and repeated times.
+
+Run from the repository root:
+
+    python -m unittest discover tests
+"""
+import json
+import random
+import unittest
+
+import numpy as np
+
+import features
+from features import fast
+
+SEED = 11
+
+
+##############################################################################
+#
+# Paths of [x, y, time] points, as normalised by geometry.
+#
+##############################################################################
+
+
+# A path from the origin towards a target, with jitter and detours.
+def random_path(rng, points):
+
+    target = rng.choice([1, -1])
+    jitter = rng.uniform(0.001, 0.2)
+
+    path = []
+    clock = 0
+    for i in range(points):
+        f = (i + 1) / points
+        path.append([target * f + rng.gauss(0, jitter), f + rng.gauss(0, jitter), clock])
+        clock += rng.choice([0, 8, 16, 33, 250, 1200])
+
+    return path
+
+
+# Points on one line, going back and forth over it, so segments
+# overlap, touch end to end or meet at a single point.
+def collinear_path(rng, points):
+
+    dx, dy = rng.choice([(1, 0), (0, 1), (1, 1), (1, -1), (0.3, 0.7)])
+    stops = [rng.choice([-1, -0.5, 0, 0.25, 0.5, 1]) for _ in range(points)]
+
+    return [[dx * s, dy * s, 16 * i] for i, s in enumerate(stops)]
+
+
+# Points on a coarse grid, so segments share end points, cross at
+# grid points and run along each other.
+def grid_path(rng, points):
+
+    step = rng.choice([1, 0.5, 0.1, 0.05])
+    return [
+        [rng.randint(-4, 4) * step, rng.randint(0, 4) * step, 16 * i]
+        for i in range(points)
+    ]
+
+
+# Dwells of many points in a small radius, around the hover radius,
+# between quick moves, with small or repeated time steps.
+def hover_path(rng, points):
+
+    path = []
+    clock = 0
+    while len(path) < points:
+        if rng.random() < 0.5:
+            cx, cy = rng.choice([(0, 0), (1, 1), (-1, 1), (rng.uniform(-1, 1), rng.uniform(0, 1))])
+            radius = rng.choice([0.001, 0.02, 0.03, 0.035, 0.05, 0.07])
+            for _ in range(rng.randint(5, 200)):
+                path.append([cx + rng.uniform(-radius, radius), cy + rng.uniform(-radius, radius), clock])
+                clock += rng.choice([0, 1, 2, 4, 8, 16])
+        else:
+            for _ in range(rng.randint(1, 20)):
+                path.append([rng.uniform(-1, 1), rng.uniform(0, 1), clock])
+                clock += rng.choice([16, 33, 300])
+
+    return path[:points]
+
+
+# A handful of points, often repeated, with repeated times.
+def tiny_path(rng, points):
+
+    return [
+        [rng.choice([-1, 0, 0.5, 1]), rng.choice([0, 0.5, 1]), rng.choice([0, 0, 5, 2000])]
+        for _ in range(points)
+    ]
+
+
+# Paths below and above fast.CROSSING_PAIRS_LIMIT, so both ways of
+# counting crossings are covered.
+def paths(make, count, longest):
+
+    rng = random.Random(f"{SEED}-{make.__name__}")
+    return [make(rng, rng.randint(1, longest)) for _ in range(count)]
+
+
+# The features of a path, or the type of the error raised.
+def outcome(extract, path):
+
+    try:
+        return json.dumps(extract(path))
+    except Exception as err:
+        return type(err).__name__
+
+
+##############################################################################
+#
+# Tests.
+#
+##############################################################################
+
+
+class FastPathFeaturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = features.PathFeatures()
+        self.fast = features.FastPathFeatures()
+
+    def assertSame(self, family, path_sets):
+        for make, count, longest in path_sets:
+            for path in paths(make, count, longest):
+                with self.subTest(make=make.__name__, points=len(path)):
+                    self.assertEqual(
+                        outcome(getattr(self.original, family), path),
+                        outcome(getattr(self.fast, family), path),
+                    )
+
+    def test_divergence(self):
+        self.assertSame("divergence", [
+            (random_path, 150, 300),
+            (collinear_path, 150, 250),
+            (grid_path, 150, 250),
+            (tiny_path, 100, 8),
+        ])
+
+    def test_hover(self):
+        self.assertSame("hover", [
+            (random_path, 100, 300),
+            (hover_path, 200, 600),
+            (grid_path, 50, 100),
+            (tiny_path, 100, 8),
+        ])
+
+    def test_extract(self):
+        self.assertSame("extract", [
+            (random_path, 50, 200),
+            (collinear_path, 30, 150),
+            (grid_path, 30, 150),
+            (hover_path, 30, 300),
+            (tiny_path, 50, 8),
+        ])
+
+    def test_count_crossings_above_pairs_limit(self):
+
+        # Long paths are counted from grid and collinear candidates;
+        # they must find every crossing testing all pairs finds.
+        limit = fast.CROSSING_PAIRS_LIMIT
+        try:
+            for make in (random_path, collinear_path, grid_path):
+                for path in paths(make, 30, 400):
+                    points = fast.as_path_array(path)
+                    x, y = points[:, 0], points[:, 1]
+
+                    fast.CROSSING_PAIRS_LIMIT = len(x)
+                    expected = fast.count_crossings(x, y)
+                    fast.CROSSING_PAIRS_LIMIT = 0
+
+                    with self.subTest(make=make.__name__, points=len(path)):
+                        self.assertEqual(expected, fast.count_crossings(x, y))
+        finally:
+            fast.CROSSING_PAIRS_LIMIT = limit
+
+    def test_collinear_pairs_found_once(self):
+
+        # Back and forth along a line whose direction is just short
+        # of pi, so every segment is also matched as its copy just
+        # above 0; each pair of segments must still come out once.
+        rng = random.Random(SEED)
+        stops = [rng.uniform(-1, 1) for _ in range(200)]
+        points = fast.as_path_array([[s, 0.5 - 1e-9 * s, i] for i, s in enumerate(stops)])
+        x, y = points[:, 0], points[:, 1]
+        px = np.concatenate(([0.0], x[:-1]))
+        py = np.concatenate(([0.0], y[:-1]))
+
+        pairs = [
+            (int(i), int(j))
+            for block_i, block_j in fast._collinear_pairs(px, py, x, y, 1.0, 1e-6)
+            for i, j in zip(block_i, block_j)
+            if i != j
+        ]
+        expected = [(i, j) for i in range(1, len(x)) for j in range(i + 1, len(x))]
+
+        self.assertEqual(sorted(pairs), expected)
+
+    def test_count_crossings_dense_dwell(self):
+
+        # Every segment of a long dwell shares a cell with every
+        # other, so candidates must come in blocks; small blocks make
+        # a 2000 point dwell span many of them.
+        rng = random.Random(SEED)
+        path = [[0.5 + rng.uniform(-0.01, 0.01), 0.5 + rng.uniform(-0.01, 0.01), i]
+                for i in range(2000)]
+
+        block = fast.CROSSING_BLOCK_PAIRS
+        fast.CROSSING_BLOCK_PAIRS = 4096
+        try:
+            self.assertEqual(
+                self.original.divergence(path)["pathCrossing"],
+                self.fast.divergence(path)["pathCrossing"],
+            )
+        finally:
+            fast.CROSSING_BLOCK_PAIRS = block
+
+
+if __name__ == "__main__":
+    unittest.main()
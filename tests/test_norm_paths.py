@@ -0,0 +1,184 @@
+"""
+bipartiteNormPaths and tripartiteNormPaths must give every path of a
+batch exactly what bipartiteNormPath and tripartiteNormPath give it on
+its own, and report the error they raise for it against that path
+alone. Besides random paths the batches hold the paths the single
+functions treat specially: empty and one point paths, stacked answers,
+times starting at zero and, for tripartite questions, the middle
+option and bad options or responses.
+
+Run from the repository root:
+
+    python -m unittest discover tests
+"""
+import random
+import unittest
+
+import geometry
+
+SEED = 14
+
+OPTIONS = {"left": "option0", "middle": "option1", "right": "option2"}
+
+
+##############################################################################
+#
+# Raw paths of (time, x, y) points, in screen coordinates.
+#
+##############################################################################
+
+
+# From a start point to an answer above it, with jitter.
+def random_path(rng, points):
+
+    x0, y0 = rng.uniform(200, 600), rng.uniform(500, 800)
+    x1, y1 = x0 + rng.choice([-1, 1]) * rng.uniform(50, 300), y0 - rng.uniform(50, 400)
+
+    path = []
+    clock = rng.choice([0, 0, 1500000])
+    for i in range(points):
+        f = i / max(points - 1, 1)
+        path.append((clock, x0 + f * (x1 - x0) + rng.gauss(0, 20), y0 + f * (y1 - y0) + rng.gauss(0, 20)))
+        clock += rng.choice([0, 8, 16, 33])
+    path[0] = (path[0][0], x0, y0)
+    path[-1] = (path[-1][0], x1, y1)
+
+    return path
+
+
+# Paths starting at time zero, with more zero times after.
+def zero_time_path(rng, points):
+
+    path = random_path(rng, points)
+    zeros = rng.randint(1, points)
+    return [(0 if i < zeros else t, x, y) for i, (t, x, y) in enumerate(path)]
+
+
+# Answers stacked: the end is level with or right above the start.
+def stacked_path(rng, points):
+
+    path = random_path(rng, points)
+    t, x, y = path[-1]
+    if rng.random() < 0.5:
+        path[-1] = (t, path[0][1], y)
+    else:
+        path[-1] = (t, x, path[0][2])
+
+    return path
+
+
+# Integer points on a small grid, so ends are often level.
+def grid_path(rng, points):
+
+    return [(16 * i, rng.randint(0, 3), rng.randint(0, 3)) for i in range(points)]
+
+
+def short_path(rng, points):
+
+    return random_path(rng, 2)[: rng.randint(0, 2)]
+
+
+def random_paths(rng, count):
+
+    makes = [random_path, zero_time_path, stacked_path, grid_path, short_path]
+    return [rng.choice(makes)(rng, rng.randint(2, 60)) for _ in range(count)]
+
+
+# The normalised path and error of a single path function.
+def single(norm, *args):
+
+    try:
+        return norm(*args), None
+    except Exception as err:
+        return [], err
+
+
+##############################################################################
+#
+# Tests.
+#
+##############################################################################
+
+
+class NormPathsTest(unittest.TestCase):
+
+    def assertSame(self, raws, batch_norm, batch_errors, expected):
+
+        self.assertEqual(len(batch_norm), len(raws))
+        for i, (path, err) in enumerate(expected):
+            with self.subTest(path=i, points=len(raws[i])):
+                self.assertEqual(batch_norm.path(i), [list(p) for p in path])
+                if err is None:
+                    self.assertNotIn(i, batch_errors)
+                else:
+                    self.assertIs(type(batch_errors.get(i)), type(err))
+                    self.assertEqual(str(batch_errors[i]), str(err))
+
+    def test_bipartite(self):
+
+        rng = random.Random(SEED)
+        for case in range(20):
+            raws = random_paths(rng, rng.randint(0, 80))
+            norm, errors = geometry.bipartiteNormPaths(geometry.PathBatch.fromPaths(raws))
+            expected = [
+                single(geometry.bipartiteNormPath, raw, {}, OPTIONS, "left", None, None)
+                for raw in raws
+            ]
+            with self.subTest(case=case):
+                self.assertSame(raws, norm, errors, expected)
+
+    def test_short_and_stacked(self):
+
+        raws = [[], [(0, 1, 1)], [(0, 1, 1), (5, 2, 2)], [(0, 1, 1), (5, 1, 2)],
+                [(0, 1, 1), (5, 2, 1)], [(0, 1, 1), (5, 1, 1)], []]
+        norm, errors = geometry.bipartiteNormPaths(geometry.PathBatch.fromPaths(raws))
+        expected = [
+            single(geometry.bipartiteNormPath, raw, {}, OPTIONS, "left", None, None)
+            for raw in raws
+        ]
+
+        self.assertSame(raws, norm, errors, expected)
+        self.assertEqual(sorted(errors), [3, 4, 5])
+
+    def test_tripartite(self):
+
+        rng = random.Random(SEED)
+        bad_options = [{"left": "option0", "right": "option2"}, None, 3]
+        for case in range(20):
+            raws = random_paths(rng, rng.randint(0, 80))
+            options, responses = [], []
+            for raw in raws:
+                if rng.random() < 0.1:
+                    options.append(rng.choice(bad_options))
+                    responses.append("left")
+                else:
+                    options.append(OPTIONS)
+                    responses.append(rng.choice(["left", "middle", "middle", "right", "up"]))
+
+            norm, errors = geometry.tripartiteNormPaths(
+                geometry.PathBatch.fromPaths(raws), options, responses
+            )
+
+            expected = []
+            for raw, opts, response in zip(raws, options, responses):
+                if not raw and opts == OPTIONS and response == "middle":
+                    # tripartiteNormPath fails on the rotated midpoint
+                    # of an empty path; as bipartite it is left empty.
+                    expected.append(([], None))
+                    continue
+                expected.append(
+                    single(geometry.tripartiteNormPath, raw, {}, opts, response, None, None)
+                )
+
+            with self.subTest(case=case):
+                self.assertSame(raws, norm, errors, expected)
+
+    def test_tripartite_needs_every_path(self):
+
+        batch = geometry.PathBatch.fromPaths([[(0, 1, 1), (5, 2, 2)]])
+        with self.assertRaises(ValueError):
+            geometry.tripartiteNormPaths(batch, [], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+FeatureStats.normalize_batch must flag every result exactly as
+FeatureStats.normalize does, one result at a time. The batch puts every
+flag in one matrix, so a flag normalize would not set for a result is
+False in its row. Results are compared as plain dicts of features and
+backed by a ResultStore, over all features and over only the ones the
+certainty model uses, with values on the thresholds, missing features
+and results with no features at all.
+
+Run from the repository root:
+
+    python -m unittest discover tests
+"""
+import random
+import unittest
+
+import features
+import paths
+import rb_models as models
+
+SEED = 6
+
+
+##############################################################################
+#
+# Results with random features.
+#
+##############################################################################
+
+
+# Features the certainty model uses, and some it does not.
+SERIES = sorted(
+    l for l in models.Model().labels()
+    if l not in ("otherHover", "upperHover", "targetHover", "otherQuadLate")
+) + ["earlySpeed", "first_movement_delay"]
+BOOLS = ["otherHover", "upperHover", "targetHover", "otherQuadLate", "earlyHover"]
+CLASSES = {"firstQuad": ["q1", "q2", "q3"], "lastQuad": ["q2", "q4", "q5", "q6"]}
+
+
+# Features of a result as {family: {label: [value, kind]}}. Values
+# come from a few small integers often enough to land on the averages.
+def random_features(rng):
+
+    if rng.random() < 0.05:
+        return {}
+
+    features = {"series": {}, "bools": {}, "classes": {}}
+    for label in SERIES:
+        if rng.random() < 0.9:
+            value = rng.choice([0, 1, 2, 3, rng.uniform(-2, 5)])
+            features["series"][label] = [value, "series"]
+    for label in BOOLS:
+        if rng.random() < 0.8:
+            features["bools"][label] = [rng.random() < 0.3, "bool"]
+    for label, classes in CLASSES.items():
+        if rng.random() < 0.8:
+            features["classes"][label] = [rng.choice(classes), "class"]
+
+    return features
+
+
+# Features lying exactly on the thresholds of fitted stats, where
+# > and >= part ways.
+def threshold_features(rng, fs):
+
+    features = random_features(rng)
+
+    for label, pair in features.get("series", {}).items():
+        if label not in fs.features:
+            continue
+        stat = fs.features[label]
+        avg, sdv, var, vsd = stat["avg"], stat["sdv"], stat["var"], stat["vsd"]
+        pair[0] = rng.choice([
+            avg, avg + sdv, avg + 2 * sdv, avg - sdv, avg - 2 * sdv,
+            var, var + vsd, var + 2 * vsd, var - vsd, var - 2 * vsd,
+        ])
+
+    return features
+
+
+def random_results(count, store=None):
+
+    rng = random.Random(f"{SEED}-{count}")
+    return [
+        paths.Result(i, f"p{i % 7}", random_features(rng), "bipartite_choice",
+                     None, None, f"q{i}", store=store)
+        for i in range(count)
+    ]
+
+
+##############################################################################
+#
+# Tests.
+#
+##############################################################################
+
+
+def fitted(results):
+
+    fs = features.FeatureStats()
+    for result in results:
+        fs.add_result(result)
+    fs.prepare_stats()
+
+    return fs
+
+
+class NormalizeBatchTest(unittest.TestCase):
+
+    def assertSame(self, results, labels=None, fs=None):
+
+        if fs is None:
+            fs = fitted(results)
+
+        norm = fs.normalize_batch(results, labels)
+
+        for i, result in enumerate(results):
+            fs.normalize(result)
+            expected = result.norm_features
+            if labels is not None:
+                keep = set(norm.columns)
+                expected = {c: v for c, v in expected.items() if c in keep}
+
+            row = norm.row(i)
+            with self.subTest(result=i, labels=labels is not None):
+                self.assertEqual(bool(row), bool(result.norm_features))
+                self.assertEqual({c: v for c, v in row.items() if c in expected}, expected)
+                self.assertFalse(any(v for c, v in row.items() if c not in expected))
+
+    def test_dict_results(self):
+        self.assertSame(random_results(400))
+
+    def test_store_results(self):
+        self.assertSame(random_results(400, paths.ResultStore()))
+
+    def test_model_labels(self):
+        labels = models.Model().labels()
+        self.assertSame(random_results(300), labels)
+        self.assertSame(random_results(300, paths.ResultStore()), labels)
+
+    def test_thresholds(self):
+
+        fs = fitted(random_results(300))
+        rng = random.Random(SEED)
+        for store in (None, paths.ResultStore()):
+            probes = [
+                paths.Result(i, "p", threshold_features(rng, fs), "bipartite_choice",
+                             None, None, f"q{i}", store=store)
+                for i in range(300)
+            ]
+            self.assertSame(probes, fs=fs)
+
+    def test_columns(self):
+
+        # A flag normalize never sets is still a column of the
+        # matrix, so row and column agree.
+        results = random_results(50)
+        norm = fitted(results).normalize_batch(results)
+
+        for c in norm.columns:
+            with self.subTest(column=c):
+                self.assertEqual(
+                    norm.column(c).tolist(),
+                    [norm.row(i).get(c, False) for i in range(len(results))],
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()